@@ -1,4 +1,5 @@
 import os
+import random
 
 import click
 from flask import Flask, render_template
@@ -12,9 +13,19 @@ from blueprints.main import main_bp
 from blueprints.rider import rider_bp
 from blueprints.shop import shop_bp
 from blueprints.user import user_bp
-from .extensions import bootstrap, db, login_manager, mail, dropzone, moment, whooshee, avatars, csrf
+from .extensions import bootstrap, db, login_manager, mail, dropzone, moment, whooshee, avatars, csrf, \
+    rider_index, shop_index, query_counter, page_cache, autocomplete_index, file_server
 # from .extensions import scheduler
-from .models import User, Dish, Tag, Follow, Notification, Comment, Collect, Order, Rider, Shop, File
+from .autocomplete import autocomplete_loader
+from .delivery import deliveries
+from .dispatch import dispatcher
+from .indexing import indexer, rebuild_indexes
+from .search import search, benchmark, sample_terms, WhoosheeBackend, FTS5Backend
+from .thumbnails import thumbnails
+from .storage import upload_sweeper, file_reaper
+from .deletion import deletions
+from .models import User, Dish, Tag, Follow, Notification, Comment, Collect, Order, Rider, Shop, File, Blob, tagging, \
+    DeletionJob
 from .settings import config
 
 
@@ -45,6 +56,21 @@ def register_extensions(app):
     whooshee.init_app(app)
     avatars.init_app(app)
     csrf.init_app(app)
+    rider_index.init_app(app)
+    shop_index.init_app(app)
+    autocomplete_index.init_app(app)
+    query_counter.init_app(app)
+    page_cache.init_app(app)
+    dispatcher.init_app(app)
+    deliveries.init_app(app)
+    indexer.init_app(app)
+    search.init_app(app)
+    autocomplete_loader.init_app(app)
+    thumbnails.init_app(app)
+    upload_sweeper.init_app(app)
+    file_reaper.init_app(app)
+    deletions.init_app(app)
+    file_server.init_app(app)
     # scheduler.init_app(app)
 
 
@@ -70,7 +96,7 @@ def register_template_context(app):
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
-            notification_count = Notification.query.with_parent(current_user).count()
+            notification_count = current_user.unread_notifications
         else:
             notification_count = None
         return dict(notification_count=notification_count)
@@ -132,15 +158,39 @@ def register_commands(app):
     @click.option('--dish', default=100, help='Quantity of dishes, default is 100.')
     @click.option('--order', default=100, help='Quantity of orders, default is 200.')
     @click.option('--shop', default=20, help='Quantity of shops, default is 20.')
-    def forge(user, follow, tag, collect, comment, dish, order, shop):
+    @click.option('--notification', default=200, help='Quantity of notifications (bulk mode), default is 200.')
+    @click.option('--image', default=100, help='Quantity of distinct dish images (bulk mode), default is 100.')
+    @click.option('--bulk', is_flag=True, help='Bulk insert without the ORM, for large benchmark datasets.')
+    @click.option('--seed', default=None, type=int, help='Random seed, the same seed generates the same data.')
+    @click.option('--processes', default=None, type=int, help='Number of image worker processes (bulk mode).')
+    @click.option('--chunk-size', default=10000, help='Rows per INSERT batch (bulk mode), default is 10000.')
+    def forge(user, follow, tag, collect, comment, dish, order, shop, notification, image, bulk, seed, processes,
+              chunk_size):
         """Generate fake data."""
 
-        from .fakes import fake_shop, fake_comment, fake_follow, fake_tag, fake_user, \
-            fake_collect, fake_dish,fake_order
+        from .fakes import fake, fake_shop, fake_comment, fake_follow, fake_tag, fake_user, \
+            fake_collect, fake_dish, fake_order, bulk_forge
 
         db.drop_all()
         db.create_all()
 
+        if bulk:
+            sizes = dict(user=user, follow=follow, tag=tag, collect=collect, comment=comment, dish=dish,
+                         order=order, shop=shop, notification=notification, image=image)
+            total, elapsed = 0, 0.0
+            for name, count, seconds in bulk_forge(sizes, seed or 0, processes, chunk_size):
+                click.echo('%-16s %10d rows %8.2fs %10d rows/s' % (name, count, seconds, count / (seconds or 1e-9)))
+                total, elapsed = total + count, elapsed + seconds
+            click.echo('%-16s %10d rows %8.2fs %10d rows/s' % ('total', total, elapsed, total / (elapsed or 1e-9)))
+            click.get_current_context().invoke(backfill_counters)
+            click.echo('Indexing...')
+            rebuild_indexes(app)
+            click.echo('Done.')
+            return
+
+        if seed is not None:
+            random.seed(seed)
+            fake.seed_instance(seed)
         click.echo('Generating %d users...' % user)
         fake_user(user)
         click.echo('Generating %d shops...' % shop)
@@ -157,4 +207,64 @@ def register_commands(app):
         fake_comment(comment)
         click.echo('Generating %d orders...' % order)
         fake_order(order)
+        click.echo('Indexing...')
+        rebuild_indexes(app)
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--processes', default=None, type=int, help='Number of worker processes, default is one per index.')
+    def reindex(processes):
+        """Rebuild the search indexes."""
+        for name, count in rebuild_indexes(app, processes):
+            click.echo('Indexed %d rows of %s.' % (count, name))
+        if app.config['YGQ_SEARCH_BACKEND'] == 'fts5':
+            click.echo('Rebuilding FTS5 tables...')
+            search.backend.build(app)
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--queries', default=100, help='Quantity of queries per category, default is 100.')
+    def benchmark_search(queries):
+        """Compare index build time and query latency of the search backends."""
+        terms = sample_terms(queries)
+        for backend in WhoosheeBackend(), FTS5Backend(app.config['YGQ_FTS5_TOKENIZER']):
+            build_time, latencies = benchmark(app, backend, terms)
+            click.echo('%s: build %.2fs' % (backend.name, build_time))
+            if backend.name == 'fts5' and not isinstance(search.backend, FTS5Backend):
+                with db.engine.begin() as connection:  # 没有启用FTS5时不留下触发器
+                    backend.drop(connection)
+            for category, values in latencies.items():
+                values.sort()
+                click.echo('    %-5s mean %.2fms  p50 %.2fms  p95 %.2fms' % (
+                    category, sum(values) / len(values), values[len(values) // 2], values[int(len(values) * 0.95)]))
+
+    @app.cli.command()
+    def run_deletions():
+        """Run the pending account and shop deletion jobs."""
+        count = DeletionJob.query.filter(DeletionJob.finished_at == None).count()
+        deletions.tick()
+        click.echo('Finished %d deletion jobs.' % count)
+
+    @app.cli.command()
+    def backfill_counters():
+        """Recalculate the denormalized counters."""
+        click.echo('Counting collects and comments of dishes...')
+        Dish.query.update({
+            Dish.collect_count: db.select([db.func.count()]).where(Collect.collected_id == Dish.id).as_scalar(),
+            Dish.comment_count: db.select([db.func.count()]).where(Comment.dish_id == Dish.id).as_scalar(),
+        }, synchronize_session=False)
+        click.echo('Counting dishes of tags...')
+        Tag.query.update({
+            Tag.dish_count: db.select([db.func.count()]).where(tagging.c.tag_id == Tag.id).as_scalar(),
+        }, synchronize_session=False)
+        click.echo('Counting references of uploaded blobs...')
+        Blob.query.update({
+            Blob.refcount: db.select([db.func.count()]).where(File.blob_id == Blob.id).as_scalar(),
+        }, synchronize_session=False)
+        click.echo('Counting unread notifications of users...')
+        User.query.update({
+            User.unread_notifications: db.select([db.func.count()]).where(
+                db.and_(Notification.receiver_id == User.id, Notification.is_read == False)).as_scalar(),
+        }, synchronize_session=False)
+        db.session.commit()
         click.echo('Done.')
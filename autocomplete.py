@@ -0,0 +1,33 @@
+from itertools import chain
+
+from .extensions import db, autocomplete_index
+from .models import Dish, Shop, Tag
+from .tasks import PeriodicWorker
+
+
+def load_autocomplete_index():
+    """从数据库重建标签、菜品和店铺名称的前缀索引"""
+    autocomplete_index.load(chain(
+        (('tag', id, name) for id, name in db.session.query(Tag.id, Tag.name)),
+        (('dish', id, name) for id, name in db.session.query(Dish.id, Dish.name)),
+        (('shop', id, name) for id, name in db.session.query(Shop.id, Shop.name).filter(Shop.deleted == False)),
+    ))
+
+
+class AutocompleteLoader(PeriodicWorker):
+    """后台载入前缀索引
+
+    进程启动时载入一次，之后本进程内的增删由models中的事件增量维护，
+    每隔YGQ_AUTOCOMPLETE_REFRESH秒整体重建一次，同步其他进程的改动。
+    """
+    name = 'ygq_autocomplete'
+    interval_key = 'YGQ_AUTOCOMPLETE_REFRESH'
+
+    def setup(self):
+        load_autocomplete_index()
+
+    def tick(self):
+        load_autocomplete_index()
+
+
+autocomplete_loader = AutocompleteLoader()
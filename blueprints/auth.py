@@ -19,7 +19,7 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower()).first()
-        if user is not None and user.validate_password(form.password.data):
+        if user is not None and not user.deleted and user.validate_password(form.password.data):
             login_user(user, form.remember_me.data)
             flash('Login success.', 'info')
             return redirect_back()
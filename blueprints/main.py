@@ -1,34 +1,83 @@
 from flask import render_template, flash, redirect, url_for, current_app, \
-    send_from_directory, request, abort, Blueprint
+    request, abort, Blueprint, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy.sql.expression import func
+from flask_sqlalchemy import Pagination
 
+from ..autocomplete import load_autocomplete_index
 from ..decorators import confirm_required, permission_required
-from ..extensions import db
+from ..extensions import db, page_cache, autocomplete_index, file_server
 from ..forms.shop import DescriptionForm, TagForm
 from ..forms.main import CommentForm
-from ..models import User, Order, Dish, Tag, Follow, Collect, Comment, Notification
+from ..loading import dish_card, comment_list
+from ..models import Order, Dish, Tag, Follow, Collect, Comment, Notification
+from ..nearby import nearby_dishes
+from ..notifications import mark_notifications_read
+from ..pagination import paginate
+from ..sampling import dish_sampler
+from ..search import search as search_backend
 from ..utils import redirect_back, flash_errors
 
 main_bp = Blueprint('main', __name__)
 
 
 @main_bp.route('/')
+@page_cache.cached
 def index():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    pagination = Dish.query.order_by(Dish.sales.desc()).paginate(page, per_page)
+    pagination = paginate(Dish.query.filter(Dish.visible()).options(*dish_card), (Dish.sales, Dish.id), per_page)
     dishes = pagination.items
-    tags = Tag.query.join(Tag.dishes).group_by(Tag.id).order_by(func.count(Dish.id).desc()).limit(10)
-    return render_template('main/index.html', pagination=pagination, dishes=dishes, tags=tags)
+    collected_ids = set()
+    if current_user.is_authenticated and dishes:
+        collected_ids = {collected_id for collected_id, in db.session.query(Collect.collected_id).filter(
+            Collect.collector_id == current_user.id, Collect.collected_id.in_([dish.id for dish in dishes]))}
+    tags = Tag.query.filter(Tag.dish_count > 0).order_by(Tag.dish_count.desc()).limit(10)
+    return render_template('main/index.html', pagination=pagination, dishes=dishes, tags=tags,
+                           collected_ids=collected_ids)
 
 
 @main_bp.route('/explore')
 def explore():
-    dishes = Dish.query.order_by(func.random()).limit(12)
+    dishes = dish_sampler.sample(current_app.config['YGQ_EXPLORE_PER_PAGE'], *dish_card)
     return render_template('main/explore.html', dishes=dishes)
 
 
+def _nearby_location():
+    """附近菜品的位置：优先使用查询参数，否则使用当前用户的位置"""
+    x = request.args.get('x', type=int)
+    y = request.args.get('y', type=int)
+    if (x is None or y is None) and current_user.is_authenticated:
+        x, y = current_user.location_x, current_user.location_y
+    return x, y
+
+
+@main_bp.route('/nearby')
+def nearby():
+    x, y = _nearby_location()
+    if x is None or y is None:
+        flash('Set your location to see dishes nearby.', 'warning')
+        return redirect_back()
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['YGQ_DISH_PER_PAGE']
+    total, results = nearby_dishes.page(x, y, page, per_page, *dish_card)
+    pagination = Pagination(None, page, per_page, total, results)
+    return render_template('main/nearby.html', pagination=pagination, results=results, x=x, y=y)
+
+
+@main_bp.route('/api/nearby')
+def nearby_api():
+    x, y = _nearby_location()
+    if x is None or y is None:
+        return jsonify(message='Location required.'), 400
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['YGQ_DISH_PER_PAGE']
+    total, results = nearby_dishes.page(x, y, page, per_page)
+    return jsonify(page=page, per_page=per_page, total=total, items=[
+        dict(id=dish.id, name=dish.name, price=dish.price, shop_id=dish.shop_id, fare=fare, distance=distance,
+             url=url_for('.show_dish', dish_id=dish.id)) for fare, distance, dish in results])
+
+
 @main_bp.route('/search')
 def search():
     q = request.args.get('q', '').strip()
@@ -39,43 +88,75 @@ def search():
     category = request.args.get('category', 'dish')
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_SEARCH_RESULT_PER_PAGE']
-    if category == 'user':
-        pagination = User.query.whooshee_search(q).paginate(page, per_page)
-    elif category == 'tag':
-        pagination = Tag.query.whooshee_search(q).paginate(page, per_page)
-    else:
-        pagination = Dish.query.whooshee_search(q).paginate(page, per_page)
+    pagination = search_backend.paginate(category, q, page, per_page)
     results = pagination.items
     return render_template('main/search.html', q=q, results=results, pagination=pagination, category=category)
 
 
+@main_bp.route('/autocomplete')
+def autocomplete():
+    q = request.args.get('q', '').strip()
+    if not autocomplete_index.loaded:  # 没有启动后台任务时(测试环境)在第一次查询时载入
+        load_autocomplete_index()
+    endpoints = {'tag': ('main.show_tag', 'tag_id'), 'dish': ('main.show_dish', 'dish_id'),
+                 'shop': ('shop.index', 'shop_id')}
+    results = []
+    for kind, id, name in autocomplete_index.search(q) if q else ():
+        endpoint, key = endpoints[kind]
+        results.append(dict(type=kind, id=id, name=name, url=url_for(endpoint, **{key: id})))
+    return jsonify(q=q, results=results)
+
+
 @main_bp.route('/notifications')
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_NOTIFICATION_PER_PAGE']
     notifications = Notification.query.with_parent(current_user)
-    pagination = notifications.order_by(Notification.timestamp.desc()).paginate(page, per_page)
+    pagination = paginate(notifications, (Notification.timestamp, Notification.id), per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
 
+@main_bp.route('/notification/read/<int:notification_id>', methods=['POST'])
+@login_required
+def read_notification(notification_id):
+    notification = Notification.query.get_or_404(notification_id)
+    if current_user != notification.receiver:
+        abort(403)
+
+    mark_notifications_read(current_user, [notification_id])
+    flash('Notification archived.', 'success')
+    return redirect(url_for('.show_notifications'))
+
+
+@main_bp.route('/notifications/read/all', methods=['POST'])
+@login_required
+def read_all_notification():
+    mark_notifications_read(current_user)
+    flash('All notifications archived.', 'success')
+    return redirect(url_for('.show_notifications'))
+
+
 @main_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['YGQ_UPLOAD_PATH'], filename)
+    return file_server.send(current_app.config['YGQ_UPLOAD_PATH'], filename)
 
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    return file_server.send(current_app.config['AVATARS_SAVE_PATH'], filename)
 
 
 @main_bp.route('/dish/<int:dish_id>')
+@page_cache.cached
 def show_dish(dish_id):
     dish = Dish.query.get_or_404(dish_id)
+    if dish.shop is not None and dish.shop.deleted:
+        abort(404)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(dish).order_by(Comment.timestamp.asc()).paginate(page, per_page)
+    pagination = Comment.query.with_parent(dish).options(*comment_list).order_by(Comment.timestamp.asc()) \
+        .paginate(page, per_page)
     comments = pagination.items
 
     comment_form = CommentForm()
@@ -177,15 +258,16 @@ def delete_dish(dish_id):
 
 @main_bp.route('/tag/<int:tag_id>', defaults={'order': 'by_time'})
 @main_bp.route('/tag/<int:tag_id>/<order>')
+@page_cache.cached
 def show_tag(tag_id, order):
     tag = Tag.query.get_or_404(tag_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    order_rule = 'time'
-    pagination = Dish.query.with_parent(tag).order_by(Dish.timestamp.desc()).paginate(page, per_page)
-    dishes = pagination.items
-
     if order == 'by_collects':
-        dishes.sort(key=lambda x: len(x.collectors), reverse=True)
         order_rule = 'collects'
+        columns = (Dish.collect_count, Dish.id)
+    else:
+        order_rule = 'time'
+        columns = (Dish.timestamp, Dish.id)
+    pagination = paginate(Dish.query.with_parent(tag).filter(Dish.visible()).options(*dish_card), columns, per_page)
+    dishes = pagination.items
     return render_template('main/tag.html', tag=tag, pagination=pagination, dishes=dishes, order_rule=order_rule)
@@ -1,8 +1,9 @@
-from flask import render_template, redirect, url_for, current_app, request, Blueprint, abort, flash
+from flask import render_template, redirect, url_for, current_app, Blueprint, abort, flash
 from flask_login import login_required, current_user
 
 from ..decorators import confirm_required
 from ..models import User, Rider, Order
+from ..pagination import paginate
 
 
 rider_bp = Blueprint('rider', __name__)
@@ -11,9 +12,8 @@ rider_bp = Blueprint('rider', __name__)
 @rider_bp.route('/<int:rider_id>', methods=['GET'])
 def index(rider_id):
     rider = Rider.query.get_or_404(rider_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    pagination = Order.query.with_parent(rider).order_by(Order.start_time.desc()).paginate(page, per_page)
+    pagination = paginate(Order.query.with_parent(rider), (Order.start_time, Order.id), per_page)
     orders = pagination.items
     return render_template('rider/index.html', rider=rider, pagination=pagination, orders=orders)
 
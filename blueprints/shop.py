@@ -1,23 +1,32 @@
-import os
+import uuid
 
-from flask import render_template, flash, redirect, url_for, current_app, request, Blueprint, abort
+from flask import render_template, flash, redirect, url_for, current_app, request, Blueprint, abort, \
+    jsonify
 from flask_login import login_required, current_user
 
 from ..decorators import confirm_required
-from ..extensions import db
+from ..deletion import deletions
+from ..extensions import db, page_cache
 from ..forms.shop import DishForm, Apply2Shop, TagForm
+from ..loading import dish_card
 from ..models import User, Dish, Shop, File, Tag
-from ..utils import redirect_back, rename_file, flash_errors, is_image
+from ..pagination import paginate
+from ..storage import save_file, write_chunk, finish_chunks, chunk_offset
+from ..tags import tag_resolver, split_tags
+from ..thumbnails import thumbnails
+from ..utils import redirect_back, flash_errors
 
 shop_bp = Blueprint('shop', __name__)
 
 
 @shop_bp.route('/<int:shop_id>')
+@page_cache.cached
 def index(shop_id):
     shop = Shop.query.get_or_404(shop_id)
-    page = request.args.get('page', 1, type=int)
+    if shop.deleted:
+        abort(404)
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    pagination = Dish.query.with_parent(shop).order_by(Dish.timestamp.desc()).paginate(page, per_page)
+    pagination = paginate(Dish.query.with_parent(shop).options(*dish_card), (Dish.timestamp, Dish.id), per_page)
     dishes = pagination.items
     return render_template('shop/index.html', shop=shop, pagination=pagination, dishes=dishes)
 
@@ -26,11 +35,12 @@ def index(shop_id):
 @login_required
 @confirm_required
 def apply2shop(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     if current_user != user:
         abort(403)
-    if user.shops:
-        return redirect(url_for('.index', shop_id=user.shops[0].id))
+    shops = [shop for shop in user.shops if not shop.deleted]
+    if shops:
+        return redirect(url_for('.index', shop_id=shops[0].id))
 
     form = Apply2Shop()
     if form.validate_on_submit():
@@ -65,6 +75,19 @@ def delete_dish(dish_id):
     return redirect_back()
 
 
+@shop_bp.route('/delete/<int:shop_id>', methods=['POST'])
+@login_required
+def delete_shop(shop_id):
+    shop = Shop.query.get_or_404(shop_id)
+    if current_user != shop.user or shop.deleted:
+        abort(403)
+    deletions.schedule(shop)
+    db.session.commit()
+    deletions.wake()
+    flash('Shop deleted.', 'info')
+    return redirect(url_for('user.index', username=current_user.username))
+
+
 @shop_bp.route('/upload/<int:shop_id>', methods=['GET', 'POST'])
 @login_required
 @confirm_required
@@ -72,23 +95,66 @@ def upload(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     if request.method == 'POST' and 'file' in request.files:
         f = request.files.get('file')
-        filename = rename_file(f.filename)
-        f.save(os.path.join(current_app.config['YGQ_UPLOAD_PATH'], filename))
-        file = File(
-            filename=filename,
-            user=shop.user,
-            is_img=is_image(os.path.join(current_app.config['YGQ_UPLOAD_PATH'], filename))
-        )
-        db.session.add(file)
+        if 'dzuuid' in request.form:  # Dropzone分块上传
+            return upload_chunk(shop, f)
+        file = save_file(f.stream, f.filename, user=shop.user, session=_upload_session())
         db.session.commit()
+        if file.is_img and file.filename_s is None:
+            thumbnails.submit(file)
     return redirect_back()
 
 
+def _upload_session():
+    return request.args.get('session', '')[:32] or None
+
+
+def upload_chunk(shop, f):
+    """把一个分块写入临时文件，最后一个分块到达后整体保存
+
+    每个请求只处理一个分块，worker的内存和占用时间与分块大小有关而与文件大小无关；
+    失败的分块由Dropzone按原偏移重传。
+    """
+    form = request.form
+    try:
+        upload_id = form['dzuuid']
+        index, count = int(form['dzchunkindex']), int(form['dztotalchunkcount'])
+        offset, total_size = int(form['dzchunkbyteoffset']), int(form['dztotalfilesize'])
+        limit = current_app.config['MAX_CONTENT_LENGTH']
+        if total_size < 0 or (limit is not None and total_size > limit):
+            raise ValueError('Invalid file size.')
+        size = write_chunk(upload_id, f.stream, offset)
+    except (KeyError, ValueError):
+        return jsonify(message='Invalid chunk.'), 400
+    if index < count - 1:
+        return jsonify(offset=size)
+
+    file = finish_chunks(upload_id, f.filename, total_size, user=shop.user, session=_upload_session())
+    if file is None:
+        return jsonify(message='Upload incomplete, please try again.'), 400
+    db.session.commit()
+    if file.is_img and file.filename_s is None:
+        thumbnails.submit(file)
+    return jsonify(offset=total_size, id=file.id)
+
+
+@shop_bp.route('/upload/<int:shop_id>/<upload_id>')
+@login_required
+def upload_offset(shop_id, upload_id):
+    """已经收到的字节数，用于断点续传"""
+    Shop.query.get_or_404(shop_id)
+    try:
+        return jsonify(offset=chunk_offset(upload_id))
+    except ValueError:
+        abort(404)
+
+
 @shop_bp.route('/shop/<int:shop_id>/dish/new', methods=['GET', 'POST'])
 @login_required
 def new_dish(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     form = DishForm()
+    if not form.upload_session.data:
+        form.upload_session.data = uuid.uuid4().hex
 
     if form.validate_on_submit():
         dish = Dish(
@@ -98,21 +164,12 @@ def new_dish(shop_id):
             name=form.name.data
         )
         db.session.add(dish)
-        db.session.commit()
-        for name in form.tag.data.split():
-            tag = Tag.query.filter_by(name=name).first()
-            if tag is None:
-                tag = Tag(name=name)
-                db.session.add(tag)
-                db.session.commit()
-            if tag not in dish.tags:
-                dish.tags.append(tag)
-                db.session.commit()
-
-        files = File.query.filter_by(is_use=False)
-        for file in files:
-            file.dish = dish
-            file.is_use = True
+        db.session.flush()
+        tag_resolver.link(dish, split_tags(form.tag.data))
+
+        # 只认领本店在这个上传会话里上传的文件
+        File.query.filter_by(user_id=shop.user_id, session=form.upload_session.data or None, is_use=False) \
+            .update({File.dish_id: dish.id, File.is_use: True}, synchronize_session=False)
         db.session.commit()
         flash('Dish published.', 'success')
         return redirect(url_for('main.show_dish', dish_id=dish.id))
@@ -129,15 +186,8 @@ def new_tag(dish_id):
 
     form = TagForm()
     if form.validate_on_submit():
-        for name in form.tag.data.split():
-            tag = Tag.query.filter_by(name=name).first()
-            if tag is None:
-                tag = Tag(name=name)
-                db.session.add(tag)
-                db.session.commit()
-            if tag not in dish.tags:
-                dish.tags.append(tag)
-                db.session.commit()
+        tag_resolver.link(dish, split_tags(form.tag.data))
+        db.session.commit()
         flash('Tag added.', 'success')
 
     flash_errors(form)
@@ -154,7 +204,7 @@ def delete_tag(dish_id, tag_id):
     dish.tags.remove(tag)
     db.session.commit()
 
-    if not tag.dishes:
+    if tag.dish_count == 0:
         db.session.delete(tag)
         db.session.commit()
 
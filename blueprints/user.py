@@ -1,18 +1,20 @@
 from flask import render_template, flash, redirect, url_for, current_app, request, Blueprint, abort
-from flask_login import login_required, current_user, fresh_login_required
+from flask_login import login_required, current_user, fresh_login_required, logout_user
 
 from ..decorators import confirm_required
+from ..deletion import deletions
+from ..delivery import deliveries
+from ..dispatch import claim_rider, assign_rider, dispatcher
 from ..emails import send_change_email_email
 from ..extensions import db, avatars
-# from ..extensions import scheduler
 from ..forms.user import EditProfileForm, UploadAvatarForm, CropAvatarForm, ChangeEmailForm, \
     ChangePasswordForm, DeleteAccountForm, EditOrder
-from ..models import User, Rider, Dish, Order, Collect
-from ..notifications import push_new_order_notification, push_delivered_notification
+from ..loading import order_card, collect_card
+from ..models import User, Dish, Order, Collect
+from ..notifications import push_new_order_notification
+from ..pagination import paginate
 from ..settings import Operations
 from ..utils import generate_token, validate_token, redirect_back, flash_errors
-from sqlalchemy.sql.expression import func
-from datetime import datetime, timedelta
 
 
 user_bp = Blueprint('user', __name__)
@@ -20,10 +22,9 @@ user_bp = Blueprint('user', __name__)
 
 @user_bp.route('/<username>', methods=['GET'])
 def index(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    pagination = Order.query.with_parent(user).order_by(Order.start_time.desc()).paginate(page, per_page)
+    pagination = paginate(Order.query.with_parent(user).options(*order_card), (Order.start_time, Order.id), per_page)
     orders = pagination.items
     return render_template('user/index.html', user=user, pagination=pagination, orders=orders)
 
@@ -34,37 +35,39 @@ def index(username):
 def buy(dish_id):
     user = current_user
     dish = Dish.query.get_or_404(dish_id)
+    if dish.shop is None or dish.shop.deleted:
+        abort(404)
     form = EditOrder()
     if form.validate_on_submit():
-        user_location_x = form.location_x.data
-        user_location_y = form.location_y.data
-        shop_location_x = dish.shop.location_x
-        shop_location_y = dish.shop.location_y
-        number = form.number.data
-        riders = Rider.query.filter_by(active=True).order_by(func.random()).limit(100)
-        distances = [(abs(rider.location_x-user_location_x)+abs(rider.location_y-user_location_y), rider.id) \
-                     for rider in riders]
-        distance = min(distances, key=lambda x: x[0])
-        rider = Rider.query.get_or_404(distance[1])
-        fare = distance[0] + abs(shop_location_x-user_location_x) + abs(shop_location_y-user_location_y)
+        rider = None
+        if not dispatcher.enabled:
+            rider, fare = claim_rider(dish.shop, form.location_x.data, form.location_y.data)
+            if rider is None:
+                flash('No rider available, please try again later.', 'warning')
+                return redirect(url_for('main.show_dish', dish_id=dish.id))
         order = Order(
             dish=dish,
             shop=dish.shop,
             consumer=user,
-            rider=rider,
-            price=dish.price*number+fare,
-            time=datetime.now()+timedelta(seconds=fare),
-            number=number
+            number=form.number.data,
+            location_x=form.location_x.data,
+            location_y=form.location_y.data
         )
         db.session.add(order)
-        rider.income += fare
-        dish.sales += 1
-        db.session.commit()
-        flash('Order successfully.', 'success')
+        dish.sales = Dish.sales + 1  # 在数据库中自增，避免并发下单时丢失更新
+        if rider is None:
+            order.price = dish.price * order.number  # 派单后再加上运费
+            db.session.commit()
+            dispatcher.submit(order)
+            flash('Order successfully, waiting for a rider.', 'success')
+        else:
+            assign_rider(order, rider, fare)
+            db.session.commit()
+            flash('Order successfully.', 'success')
+            deliveries.schedule(order)
+            push_new_order_notification(order, rider.user)
 
-        push_new_order_notification(order, order.rider.user)
         push_new_order_notification(order, order.shop.user)
-        # scheduler.add_job(func=push_delivered_notification(), trigger="date", run_date=order.time, timezone="Asia/Shanghai")
         return redirect(url_for('.show_order', order_id=order.id))
     form.location_x.data = user.location_x
     form.location_y.data = user.location_y
@@ -82,10 +85,10 @@ def show_order(order_id):
 
 @user_bp.route('/<username>/collections', methods=['GET'])
 def show_collections(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     per_page = current_app.config['YGQ_DISH_PER_PAGE']
-    pagination = Collect.query.with_parent(user).order_by(Collect.timestamp.desc()).paginate(page, per_page)
+    pagination = paginate(Collect.query.with_parent(user).options(*collect_card),
+                          (Collect.timestamp, Collect.collected_id), per_page)
     collects = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collects=collects)
 
@@ -94,7 +97,7 @@ def show_collections(username):
 @login_required
 @confirm_required
 def follow(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     if current_user.is_following(user):
         flash('Already followed.', 'info')
         return redirect(url_for('.index', username=username))
@@ -107,7 +110,7 @@ def follow(username):
 @user_bp.route('/unfollow/<username>', methods=['POST'])
 @login_required
 def unfollow(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     if not current_user.is_following(user):
         flash('Not follow yet.', 'info')
         return redirect(url_for('.index', username=username))
@@ -119,7 +122,7 @@ def unfollow(username):
 
 @user_bp.route('/<username>/followers', methods=['GET'])
 def show_followers(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.filter_by(username=username, deleted=False).first_or_404()
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['YGQ_USER_PER_PAGE']
     pagination = user.followers.paginate(page, per_page)
@@ -235,8 +238,10 @@ def change_email(token):
 def delete_account():
     form = DeleteAccountForm()
     if form.validate_on_submit():
-        db.session.delete(current_user._get_current_object())
+        deletions.schedule(current_user._get_current_object())
         db.session.commit()
+        deletions.wake()
+        logout_user()
         flash('Your are free, goodbye!', 'success')
         return redirect(url_for('main.index'))
     return render_template('user/settings/delete_account.html', form=form)
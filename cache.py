@@ -0,0 +1,141 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+
+class LRUBackend(object):
+    """进程内的LRU缓存，条目数有上限，只在单进程部署时能及时失效"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (过期时间, value)
+        self._counters = {}  # 计数器不参与淘汰
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] is not None and item[0] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data[key] = (time.time() + timeout if timeout else None, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisBackend(object):
+    """Redis缓存，多个gunicorn worker共享，失效对所有进程立即生效"""
+
+    def __init__(self, url, prefix):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self._redis.set(self.prefix + key, pickle.dumps(value), ex=timeout or None)
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def counter(self, key):
+        return int(self._redis.get(self.prefix + key) or 0)
+
+    def incr(self, key):
+        # 计数器不经过pickle，用INCR保证多进程下原子递增
+        return self._redis.incr(self.prefix + key)
+
+
+class PageCache(object):
+    """未登录用户的整页缓存
+
+    只缓存未登录用户的GET请求，键为完整路径(包括查询字符串)加上一个版本号。
+    Dish、Comment、Collect、Tag、Shop有改动的事务提交后版本号加一，旧的缓存全部失效，
+    自然被LRU淘汰或超时清除。YGQ_PAGE_CACHE为None时不启用。
+    lru后端的版本号在进程内，其他进程收不到失效，多进程部署(WEB_CONCURRENCY大于1)时不启用，需要使用redis。
+    """
+    generation_key = 'generation'
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.timeout = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['YGQ_PAGE_CACHE']
+        self.timeout = app.config['YGQ_PAGE_CACHE_TIMEOUT']
+        if backend == 'lru' and int(os.getenv('WEB_CONCURRENCY', 1)) > 1:
+            app.logger.warning('The lru page cache cannot be invalidated across %s workers, '
+                               'page cache disabled. Set YGQ_PAGE_CACHE=redis.', os.getenv('WEB_CONCURRENCY'))
+            backend = None
+        if backend == 'lru':
+            self.backend = LRUBackend(app.config['YGQ_PAGE_CACHE_SIZE'])
+        elif backend == 'redis':
+            self.backend = RedisBackend(app.config['YGQ_PAGE_CACHE_REDIS_URL'], 'ygq:page:')  # 需要安装redis
+        else:
+            self.backend = None
+        app.extensions['ygq_page_cache'] = self
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def invalidate(self):
+        if self.enabled:
+            self.backend.incr(self.generation_key)
+
+    def _key(self):
+        generation = self.backend.counter(self.generation_key)
+        return '%s:%s' % (generation, request.full_path)
+
+    def cached(self, func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            # 有闪现消息时页面内容因人而异，不读也不写缓存
+            if not self.enabled or request.method != 'GET' or current_user.is_authenticated \
+                    or session.get('_flashes'):
+                return func(*args, **kwargs)
+            key = self._key()
+            hit = self.backend.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                response = make_response(body)
+                response.mimetype = mimetype
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response
+            response = make_response(func(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                self.backend.set(key, (response.get_data(), response.mimetype), self.timeout)
+            response.headers['X-Page-Cache'] = 'MISS'
+            return response
+        return decorated_function
@@ -0,0 +1,248 @@
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import bindparam, select, func
+
+from .extensions import db, rider_index, shop_index, autocomplete_index
+from .indexing import indexer
+from .models import User, Shop, Rider, Dish, Order, Comment, Collect, Follow, Notification, File, Blob, Tag, \
+    DeletionJob, tagging, journal_files
+from .tasks import PeriodicWorker
+
+
+def _decrement(table, column, counts):
+    """counts为[(id, 减少的数量)]，用一条executemany更新计数"""
+    params = [{'_id': pk, '_delta': delta} for pk, delta in counts if delta]
+    if params:
+        db.session.execute(table.update().where(table.c.id == bindparam('_id'))
+                           .values({column: table.c[column] - bindparam('_delta')}), params)
+
+
+def _ids(column, condition, limit):
+    return [pk for (pk,) in db.session.query(column).filter(condition).limit(limit)]
+
+
+def _delete_files(ids):
+    """删除一批File，维护Blob的引用计数，不再被引用的文件记入删除日志"""
+    files = db.session.query(File.id, File.blob_id, File.filename, File.filename_s, File.filename_m) \
+        .filter(File.id.in_(ids)).all()
+    counts = Counter(file.blob_id for file in files if file.blob_id is not None)
+    _decrement(Blob.__table__, 'refcount', counts.items())
+    dead = set(_ids(Blob.id, db.and_(Blob.id.in_(counts), Blob.refcount <= 0), len(counts))) if counts else set()
+    journal_files(db.session, db.session, 'YGQ_UPLOAD_PATH',
+                  [filename for file in files if file.blob_id is None or file.blob_id in dead
+                   for filename in (file.filename, file.filename_s, file.filename_m)])
+    if dead:
+        db.session.execute(Blob.__table__.delete().where(Blob.id.in_(dead)))
+    db.session.execute(File.__table__.delete().where(File.id.in_(ids)))
+    return len(ids)
+
+
+def _delete_dishes(ids):
+    """删除一批菜品及其标签关联、评论、收藏和文件，维护标签的菜品数"""
+    counts = db.session.execute(select([tagging.c.tag_id, func.count()])
+                                .where(tagging.c.dish_id.in_(ids)).group_by(tagging.c.tag_id)).fetchall()
+    _decrement(Tag.__table__, 'dish_count', counts)
+    db.session.execute(tagging.delete().where(tagging.c.dish_id.in_(ids)))
+    db.session.execute(Comment.__table__.delete().where(Comment.dish_id.in_(ids)))
+    db.session.execute(Collect.__table__.delete().where(Collect.collected_id.in_(ids)))
+    file_ids = [pk for (pk,) in db.session.query(File.id).filter(File.dish_id.in_(ids))]
+    if file_ids:
+        _delete_files(file_ids)
+    db.session.execute(Dish.__table__.delete().where(Dish.id.in_(ids)))
+    indexer.index_later(db.session, Dish, ids, deleted=True)
+    for pk in ids:
+        autocomplete_index.remove('dish', pk)
+    db.session.info['page_cache_dirty'] = True
+    return len(ids)
+
+
+def delete_shop_batch(shop_id, batch_size):
+    """删除店铺的一批订单或菜品，都删完后删除店铺，返回删除的行数，0表示店铺已经删完"""
+    ids = _ids(Order.id, Order.shop_id == shop_id, batch_size)  # 先删订单，之后删菜品时不用再处理订单
+    if ids:
+        # 未送达的订单不会再由DeliveryScheduler完成，在这里释放送单的骑手
+        busy = select([Order.rider_id]).where(db.and_(Order.id.in_(ids), Order.is_finish == False))
+        db.session.execute(Rider.__table__.update().where(Rider.id.in_(busy)).values(busy=False))
+        db.session.execute(Order.__table__.delete().where(Order.id.in_(ids)))
+        return len(ids)
+    ids = _ids(Dish.id, Dish.shop_id == shop_id, batch_size)
+    if ids:
+        return _delete_dishes(ids)
+    if db.session.execute(Shop.__table__.delete().where(Shop.id == shop_id)).rowcount:
+        shop_index.remove(shop_id)
+        autocomplete_index.remove('shop', shop_id)
+        return 1
+    return 0
+
+
+def _delete_user_shops(user_id, batch_size):
+    shop_id = db.session.query(Shop.id).filter(Shop.user_id == user_id).limit(1).scalar()
+    return delete_shop_batch(shop_id, batch_size) if shop_id is not None else 0
+
+
+def _delete_user_rider(user_id, batch_size):
+    rider_id = db.session.query(Rider.id).filter(Rider.user_id == user_id).limit(1).scalar()
+    if rider_id is None:
+        return 0
+    ids = _ids(Order.id, Order.rider_id == rider_id, batch_size)
+    if ids:  # 与ORM删除一致，保留订单，只解除关联
+        db.session.execute(Order.__table__.update().where(Order.id.in_(ids)).values(rider_id=None))
+        return len(ids)
+    db.session.execute(Rider.__table__.delete().where(Rider.id == rider_id))
+    rider_index.remove(rider_id)
+    return 1
+
+
+def _delete_user_orders(user_id, batch_size):
+    ids = _ids(Order.id, Order.consumer_id == user_id, batch_size)
+    if ids:
+        db.session.execute(Order.__table__.update().where(Order.id.in_(ids)).values(consumer_id=None))
+    return len(ids)
+
+
+def _delete_user_comments(user_id, batch_size):
+    """删除一批评论和它们的回复(与ORM的级联一致)，维护菜品的评论数"""
+    ids = set(_ids(Comment.id, Comment.author_id == user_id, batch_size))
+    replies = ids
+    while replies:
+        replies = set(_ids(Comment.id, db.and_(Comment.replied_id.in_(replies), ~Comment.id.in_(ids)), None))
+        ids |= replies
+    if ids:
+        counts = db.session.query(Comment.dish_id, func.count()).filter(Comment.id.in_(ids)) \
+            .group_by(Comment.dish_id).all()
+        _decrement(Dish.__table__, 'comment_count', counts)
+        db.session.execute(Comment.__table__.delete().where(Comment.id.in_(ids)))
+        db.session.info['page_cache_dirty'] = True
+    return len(ids)
+
+
+def _delete_user_collections(user_id, batch_size):
+    ids = _ids(Collect.collected_id, Collect.collector_id == user_id, batch_size)
+    if ids:
+        _decrement(Dish.__table__, 'collect_count', [(pk, 1) for pk in ids])
+        db.session.execute(Collect.__table__.delete().where(
+            db.and_(Collect.collector_id == user_id, Collect.collected_id.in_(ids))))
+        db.session.info['page_cache_dirty'] = True
+    return len(ids)
+
+
+def _delete_user_following(user_id, batch_size):
+    ids = _ids(Follow.followed_id, Follow.follower_id == user_id, batch_size)
+    if ids:
+        db.session.execute(Follow.__table__.delete().where(
+            db.and_(Follow.follower_id == user_id, Follow.followed_id.in_(ids))))
+    return len(ids)
+
+
+def _delete_user_followers(user_id, batch_size):
+    ids = _ids(Follow.follower_id, Follow.followed_id == user_id, batch_size)
+    if ids:
+        db.session.execute(Follow.__table__.delete().where(
+            db.and_(Follow.followed_id == user_id, Follow.follower_id.in_(ids))))
+    return len(ids)
+
+
+def _delete_user_notifications(user_id, batch_size):
+    ids = _ids(Notification.id, Notification.receiver_id == user_id, batch_size)
+    if ids:
+        db.session.execute(Notification.__table__.delete().where(Notification.id.in_(ids)))
+    return len(ids)
+
+
+def _delete_user_files(user_id, batch_size):
+    ids = _ids(File.id, File.user_id == user_id, batch_size)
+    return _delete_files(ids) if ids else 0
+
+
+def _delete_user(user_id, batch_size):
+    user = db.session.query(User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw) \
+        .filter(User.id == user_id).first()
+    if user is None:
+        return 0
+    journal_files(db.session, db.session, 'AVATARS_SAVE_PATH', user)
+    db.session.execute(User.__table__.delete().where(User.id == user_id))
+    indexer.index_later(db.session, User, [user_id], deleted=True)
+    return 1
+
+
+# 每种任务依次执行的阶段，每个阶段的函数删除一批记录并返回行数，返回0时进入下一阶段
+STAGES = {
+    'shop': [('shop', delete_shop_batch)],
+    'user': [
+        ('shops', _delete_user_shops),
+        ('rider', _delete_user_rider),
+        ('orders', _delete_user_orders),
+        ('comments', _delete_user_comments),
+        ('collections', _delete_user_collections),
+        ('following', _delete_user_following),
+        ('followers', _delete_user_followers),
+        ('notifications', _delete_user_notifications),
+        ('files', _delete_user_files),
+        ('user', _delete_user),
+    ],
+}
+
+
+class DeletionWorker(PeriodicWorker):
+    """后台分批删除用户和店铺
+
+    删除账户或店铺时请求只把它标记为已删除(墓碑)并创建一个DeletionJob，页面上立即不再显示；
+    后台线程按STAGES的顺序每次用集合操作删除YGQ_DELETION_BATCH_SIZE条依赖记录，
+    每批一个短事务，并在事务里维护收藏数、评论数、标签菜品数和Blob引用计数，
+    批之间暂停YGQ_DELETION_PAUSE秒，SQLite的写锁不会被长时间占用。
+    任务的进度(阶段和已删除的行数)保存在数据库里，重启后从中断的阶段继续。
+    请求里从不执行删除；没有启动后台任务时(测试环境)用flask run-deletions或run_once()执行。
+    """
+    name = 'ygq_deletion'
+    interval_key = 'YGQ_DELETION_TICK'
+
+    def schedule(self, target):
+        """标记为已删除并创建删除任务(需要提交，提交后调用wake)，返回任务"""
+        target.deleted = True
+        if isinstance(target, User):
+            for shop in target.shops:
+                shop.deleted = True
+            for rider in target.rider:
+                rider.active = False
+            db.session.info['page_cache_dirty'] = True
+        job = DeletionJob(kind=target.__tablename__, target_id=target.id, stage=STAGES[target.__tablename__][0][0])
+        db.session.add(job)
+        return job
+
+    def tick(self):
+        for (job_id,) in db.session.query(DeletionJob.id).filter(DeletionJob.finished_at == None) \
+                .order_by(DeletionJob.id).all():
+            self.run(job_id)
+
+    def run(self, job_id):
+        pause = current_app.config['YGQ_DELETION_PAUSE']
+        while self.step(job_id):
+            if pause and current_app.config['YGQ_BACKGROUND_TASKS']:
+                time.sleep(pause)
+
+    def step(self, job_id):
+        """执行任务的一批删除，返回任务是否还有剩余"""
+        # 先更新任务行加锁，多个进程不会同时处理同一个任务
+        if not DeletionJob.query.filter_by(id=job_id, finished_at=None).update(
+                {DeletionJob.batches: DeletionJob.batches + 1}, synchronize_session=False):
+            db.session.rollback()
+            return False
+        job = DeletionJob.query.populate_existing().get(job_id)
+        stages = STAGES[job.kind]
+        names = [name for name, delete in stages]
+        position = names.index(job.stage)
+        count = stages[position][1](job.target_id, current_app.config['YGQ_DELETION_BATCH_SIZE'])
+        if count:
+            job.deleted += count
+        elif position + 1 < len(stages):
+            job.stage = names[position + 1]
+        else:
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return job.finished_at is None
+
+
+deletions = DeletionWorker()
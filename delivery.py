@@ -0,0 +1,86 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from .extensions import db
+from .models import Order, Rider
+from .notifications import push_delivered_notification
+from .tasks import PeriodicWorker
+
+
+class DeliveryScheduler(PeriodicWorker):
+    """订单送达调度
+
+    待送达的订单按送达时间放在小顶堆里，每隔YGQ_DELIVERY_TICK秒醒来一次，
+    把所有到期的订单在同一个事务里标记为完成并推送送达消息。
+    启动时以及每隔YGQ_DELIVERY_RESCAN秒从Order.time恢复未完成的订单，
+    其他进程或重启前留下的订单也不会丢。多个进程可能持有同一订单，
+    完成时用条件更新保证只有一个进程推送消息，同时把送单的骑手重新标记为空闲。
+    """
+    name = 'ygq_delivery'
+    interval_key = 'YGQ_DELIVERY_TICK'
+
+    def __init__(self, app=None):
+        self._heap = []  # (送达时间, 订单id)
+        self._scheduled = set()
+        self._heap_lock = threading.Lock()
+        self._recovered_at = None
+        super(DeliveryScheduler, self).__init__(app)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, order):
+        self._push(order.time, order.id)
+
+    def _push(self, due, order_id):
+        with self._heap_lock:
+            if order_id not in self._scheduled:
+                self._scheduled.add(order_id)
+                heapq.heappush(self._heap, (due, order_id))
+
+    def _pop_due(self, now):
+        ids = []
+        with self._heap_lock:
+            while self._heap and self._heap[0][0] <= now:
+                order_id = heapq.heappop(self._heap)[1]
+                self._scheduled.discard(order_id)
+                ids.append(order_id)
+        return ids
+
+    def recover(self):
+        """从数据库载入所有已派单但未完成的订单"""
+        pending = db.session.query(Order.time, Order.id).filter(Order.is_finish == False, Order.time != None)
+        for due, order_id in pending:
+            self._push(due, order_id)
+        self._recovered_at = time.time()
+
+    def setup(self):
+        self.recover()
+
+    def tick(self):
+        if self._recovered_at is None or time.time() - self._recovered_at > self.app.config['YGQ_DELIVERY_RESCAN']:
+            self.recover()
+        ids = self._pop_due(datetime.utcnow())
+        if ids:
+            self.finish(ids)
+
+    def finish(self, ids):
+        """在一个事务里完成订单、释放骑手并推送送达消息，返回本进程完成的订单数"""
+        finished = 0
+        riders = set()
+        for order in Order.query.filter(Order.id.in_(ids)).all():
+            if Order.query.filter_by(id=order.id, is_finish=False).update(
+                    {Order.is_finish: True}, synchronize_session=False):
+                push_delivered_notification(order, commit=False)
+                finished += 1
+                if order.rider_id is not None:
+                    riders.add(order.rider_id)
+        if riders:
+            Rider.query.filter(Rider.id.in_(riders)).update({Rider.busy: False}, synchronize_session=False)
+        db.session.commit()
+        return finished
+
+
+deliveries = DeliveryScheduler()
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+from .delivery import deliveries
+from .extensions import db, rider_index
+from .geo import manhattan
+from .models import Rider, Order
+from .notifications import push_new_order_notification
+from .tasks import PeriodicWorker
+
+
+def load_rider_index():
+    """从数据库重建在线骑手的空间索引"""
+    points = db.session.query(Rider.id, Rider.location_x, Rider.location_y).filter(Rider.active == True)
+    rider_index.load(points)
+
+
+def compute_fare(shop, x, y, distance):
+    """运费 = 骑手到用户的距离 + 商家到用户的距离"""
+    return distance + manhattan(shop.location_x, shop.location_y, x, y)
+
+
+def claim_rider(shop, x, y):
+    """为商家送往(x, y)的订单领取最近的骑手，返回(骑手, 运费)，没有可用骑手时返回(None, None)
+
+    候选骑手来自进程内的空间索引，用一次查询确认他们仍然在线且空闲后，按距离依次尝试接单。
+    被其他进程抢先接单的骑手会被跳过；索引过期导致候选全部失效时，重建索引后再试一次。
+    """
+    k = current_app.config['YGQ_DISPATCH_CANDIDATES']
+    for retry in range(2):
+        if retry or rider_index.expired:
+            load_rider_index()
+        candidates = rider_index.nearest(x, y, k)
+        if not candidates:
+            return None, None
+        riders = Rider.query.filter(Rider.id.in_([id for _, id in candidates]), Rider.active == True,
+                                    Rider.busy == False).all()
+        riders.sort(key=lambda r: (manhattan(r.location_x, r.location_y, x, y), r.id))
+        for rider in riders:
+            fare = compute_fare(shop, x, y, manhattan(rider.location_x, rider.location_y, x, y))
+            if rider.claim(fare):
+                return rider, fare
+    return None, None
+
+
+def assign_rider(order, rider, fare):
+    """记录接单骑手，并把运费计入订单"""
+    order.rider = rider
+    order.fare = fare
+    order.price = order.dish.price * order.number + fare
+    order.time = datetime.utcnow() + timedelta(seconds=fare)  # 预计送达时间
+
+
+def _greedy_assignment(cost):
+    """没有scipy时的近似解：每次取整个矩阵里最小的一项"""
+    cost = cost.astype(float)
+    rows, cols = [], []
+    for _ in range(min(cost.shape)):
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        rows.append(i)
+        cols.append(j)
+        cost[i, :] = np.inf
+        cost[:, j] = np.inf
+    return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+def solve_assignment(cost):
+    """求骑手(行)与订单(列)的最小总运费匹配，返回(行下标, 列下标)"""
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    return _greedy_assignment(cost)
+
+
+class BatchDispatcher(PeriodicWorker):
+    """批量派单
+
+    下单时只把订单放进队列，每隔YGQ_DISPATCH_WINDOW秒把这段时间内的订单一起分配：
+    用NumPy算出候选骑手到各订单的运费矩阵，求总运费最小的匹配，一次提交。
+    骑手不够时没分到的订单留到下一轮，出错时整批放回队列。
+    启动时以及每隔YGQ_DISPATCH_RESCAN秒扫描还没有骑手的订单，重启前或其他进程留下的也不会漏掉。
+    """
+    name = 'ygq_dispatcher'
+    interval_key = 'YGQ_DISPATCH_WINDOW'
+
+    def __init__(self, app=None):
+        self._queue = deque()
+        self._queue_lock = threading.Lock()
+        self._recovered_at = None
+        super(BatchDispatcher, self).__init__(app)
+
+    @property
+    def enabled(self):
+        return current_app.config['YGQ_DISPATCH_MODE'] == 'batch' and current_app.config['YGQ_BACKGROUND_TASKS']
+
+    def submit(self, order):
+        self._requeue([order.id])
+        self.start()
+
+    def _requeue(self, ids):
+        with self._queue_lock:
+            self._queue.extend(ids)
+
+    def _drain(self):
+        with self._queue_lock:
+            ids = list(set(self._queue))
+            self._queue.clear()
+        return ids
+
+    def recover(self):
+        """找出还没有骑手的未完成订单"""
+        pending = db.session.query(Order.id).filter(Order.rider_id == None, Order.is_finish == False)
+        self._requeue(id for (id,) in pending)
+        self._recovered_at = time.time()
+
+    def setup(self):
+        if self.enabled:
+            self.recover()
+
+    def tick(self):
+        if not self.enabled:
+            return
+        if self._recovered_at is None or \
+                time.time() - self._recovered_at > self.app.config['YGQ_DISPATCH_RESCAN']:
+            self.recover()
+        ids = self._drain()
+        if not ids:
+            return
+        try:
+            self.dispatch(ids)
+        except Exception:
+            self._requeue(ids)
+            raise
+
+    def dispatch(self, ids):
+        """为ids中还没有骑手的订单派单，没分到骑手的放回队列"""
+        orders = Order.query.filter(Order.id.in_(ids), Order.rider_id == None, Order.is_finish == False).all()
+        if not orders:
+            return
+        if rider_index.expired:
+            load_rider_index()
+
+        k = max(current_app.config['YGQ_DISPATCH_CANDIDATES'], len(orders))
+        candidate_ids = set()
+        for order in orders:
+            candidate_ids.update(id for _, id in rider_index.nearest(order.location_x, order.location_y, k))
+        riders = Rider.query.filter(Rider.id.in_(candidate_ids), Rider.active == True, Rider.busy == False).all() \
+            if candidate_ids else []
+        if not riders:
+            self._requeue(order.id for order in orders)
+            return
+
+        rx = np.array([rider.location_x for rider in riders])
+        ry = np.array([rider.location_y for rider in riders])
+        ux = np.array([order.location_x for order in orders])
+        uy = np.array([order.location_y for order in orders])
+        shop_distance = np.array([manhattan(order.shop.location_x, order.shop.location_y,
+                                            order.location_x, order.location_y) for order in orders])
+        fares = np.abs(rx[:, None] - ux[None, :]) + np.abs(ry[:, None] - uy[None, :]) + shop_distance[None, :]
+        rows, cols = solve_assignment(fares)
+
+        assigned = set()
+        for i, j in zip(rows, cols):
+            fare = int(fares[i, j])
+            # 先占住订单，其他进程已经派出的订单跳过；骑手可能刚被其他进程抢走，订单留到下一轮
+            if not Order.query.filter_by(id=orders[j].id, rider_id=None).update(
+                    {Order.rider_id: riders[i].id}, synchronize_session=False):
+                continue
+            if riders[i].claim(fare):
+                assign_rider(orders[j], riders[i], fare)
+                assigned.add(j)
+            else:
+                Order.query.filter_by(id=orders[j].id).update({Order.rider_id: None}, synchronize_session=False)
+        for j in assigned:
+            push_new_order_notification(orders[j], orders[j].rider.user, commit=False)
+        db.session.commit()
+        self._requeue(order.id for j, order in enumerate(orders) if j not in assigned)
+        for j in assigned:
+            deliveries.schedule(orders[j])
+
+
+dispatcher = BatchDispatcher()
@@ -9,6 +9,12 @@ from flask_whooshee import Whooshee
 from flask_wtf import CSRFProtect
 from flask_apscheduler import APScheduler as _BaseAPScheduler
 
+from .cache import PageCache
+from .geo import GridIndex
+from .prefix import PrefixIndex
+from .querycount import QueryCounter
+from .serving import FileServer
+
 
 class APScheduler(_BaseAPScheduler):
     """重写APScheduler，实现上下文管理机制，小优化功能也可以不要。对于任务函数涉及数据库操作有用"""
@@ -26,6 +32,12 @@ moment = Moment()
 whooshee = Whooshee()
 avatars = Avatars()
 csrf = CSRFProtect()
+rider_index = GridIndex('YGQ_RIDER_INDEX')  # 在线骑手的空间索引
+shop_index = GridIndex('YGQ_SHOP_INDEX')  # 店铺的空间索引
+autocomplete_index = PrefixIndex('YGQ_AUTOCOMPLETE')  # 标签、菜品和店铺名称的前缀索引
+query_counter = QueryCounter()
+page_cache = PageCache()  # 未登录用户的整页缓存
+file_server = FileServer()  # 静态文件和上传文件
 # scheduler = APScheduler()
 # scheduler.start()
 
@@ -34,6 +46,8 @@ csrf = CSRFProtect()
 def load_user(user_id):
     from .models import User
     user = User.query.get(int(user_id))
+    if user is not None and user.deleted:  # 已删除的账户
+        return None
     return user
 
 
@@ -1,14 +1,24 @@
+import hashlib
 import os
 import random
+import time
+from array import array
+from io import BytesIO
+from multiprocessing import Pool
 
 from PIL import Image
 from faker import Faker
-from flask import current_app
+from flask import current_app, url_for
+from flask_avatars import Identicon
+from sqlalchemy import bindparam
 from sqlalchemy.exc import IntegrityError
-from datetime import timedelta
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
 from .extensions import db
-from .models import User, Dish, Tag, Comment, Order, File, Shop, Rider
+from .models import User, Dish, Tag, Comment, Order, Shop, Rider, Follow, Collect, Notification, File, Blob, tagging
 from .notifications import push_new_order_notification, push_delivered_notification
+from .storage import save_file
+from .utils import resize_image
 
 fake = Faker("zh_CN")
 
@@ -71,15 +81,16 @@ def fake_shop(count=20):
 def fake_dish(count=100):
     upload_path = current_app.config['YGQ_UPLOAD_PATH']
     for i in range(count):
-        filename = 'random_%d.jpg' % i
         r = lambda: random.randint(128, 255)
         img = Image.new(mode='RGB', size=(800, 800), color=(r(), r(), r()))
-        img.save(os.path.join(upload_path, filename))
-        file = File(
-            filename=filename,
-            is_use=True,
-            is_img=True
-        )
+        data = BytesIO()
+        img.save(data, format='JPEG')
+        data.seek(0)
+        file = save_file(data, 'random_%d.jpg' % i, is_use=True)
+        if file.filename_s is None:
+            path = os.path.join(upload_path, file.filename)
+            file.filename_s = resize_image(path, file.filename, current_app.config['YGQ_DISH_SIZE']['small'])
+            file.filename_m = resize_image(path, file.filename, current_app.config['YGQ_DISH_SIZE']['medium'])
 
         dish = Dish(
             name=fake.name(),
@@ -141,3 +152,193 @@ def fake_order(count=200):
         )
         db.session.add(order)
     db.session.commit()
+
+
+# 批量生成：用于压测的大数据集。不经过ORM，按块executemany插入，主键事先分配好，
+# 外键直接从id范围中随机抽取，不再在循环里查询；计数字段最后用集合操作统一回填。
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _bulk_insert(table, rows, chunk_size):
+    count = 0
+    for chunk in _chunks(rows, chunk_size):
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
+def _init_image_worker():
+    from . import create_app
+    create_app().app_context().push()
+
+
+def _forge_image(args):
+    """在子进程中生成一张图片和缩略图，返回(摘要, 文件名, 大小, 小图, 中图)"""
+    seed, index = args
+    rng = random.Random('%s-%d' % (seed, index))
+    img = Image.new(mode='RGB', size=(800, 800), color=tuple(rng.randint(128, 255) for _ in range(3)))
+    data = BytesIO()
+    img.save(data, format='JPEG')
+    raw = data.getvalue()
+    digest = hashlib.sha256(raw).hexdigest()
+    filename = digest + '.jpg'
+    path = os.path.join(current_app.config['YGQ_UPLOAD_PATH'], filename)
+    with open(path, 'wb') as f:
+        f.write(raw)
+    sizes = current_app.config['YGQ_DISH_SIZE']
+    return (digest, filename, len(raw), resize_image(path, filename, sizes['small']),
+            resize_image(path, filename, sizes['medium']))
+
+
+def bulk_forge(sizes, seed=0, processes=None, chunk_size=10000):
+    """按sizes({表: 行数})批量生成数据，每完成一张表产出(表名, 行数, 秒数)
+
+    相同的seed生成相同的数据。图片由进程池并行生成，菜品循环使用这些图片(按内容去重)。
+    """
+    rng = random.Random(seed)
+    fake.seed_instance(seed)
+    now = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)  # 同一天内生成的时间也相同
+    year = 365 * 24 * 3600
+
+    def moment():
+        return now - timedelta(seconds=rng.randint(0, year))
+
+    # Faker比较慢，先生成一批文本循环使用
+    names = [fake.name() for _ in range(1000)]
+    sentences = [fake.sentence() for _ in range(1000)]
+    texts = [fake.text() for _ in range(200)]
+    password_hash = generate_password_hash('123456')  # 所有用户共用一个密码哈希
+
+    if db.engine.name == 'sqlite':  # 生成的数据可以重建，不需要每次提交都刷盘
+        db.session.execute('PRAGMA synchronous = OFF')
+
+    def timed(name, func):
+        start = time.perf_counter()
+        count = func()
+        return name, count, time.perf_counter() - start
+
+    users, shops, dishes, orders = sizes['user'], sizes['shop'], sizes['dish'], sizes['order']
+
+    # 头像：生成少量identicon轮流使用
+    avatars = [Identicon().generate(text='forge%d' % i) for i in range(min(16, max(users, 1)))]
+    yield timed('user', lambda: _bulk_insert(User.__table__, (dict(
+        id=i, username='user%d' % i, email='user%d@example.com' % i, tel=str(13000000000 + i),
+        name=rng.choice(names), password_hash=password_hash, confirmed=True, deleted=False,
+        location_x=rng.randint(0, 1000), location_y=rng.randint(0, 1000), unread_notifications=0,
+        avatar_s=avatars[i % len(avatars)][0], avatar_m=avatars[i % len(avatars)][1],
+        avatar_l=avatars[i % len(avatars)][2]) for i in range(1, users + 1)), chunk_size))
+    yield timed('rider', lambda: _bulk_insert(Rider.__table__, (dict(
+        id=i, user_id=i, location_x=rng.randint(0, 1000), location_y=rng.randint(0, 1000),
+        income=0, active=False, busy=False) for i in range(1, users + 1)), chunk_size))
+
+    def follows():
+        pairs = {(i, i) for i in range(1, users + 1)}  # 关注自己
+        for _ in range(sizes['follow']):
+            pairs.add((rng.randint(1, users), rng.randint(1, users)))
+        return (dict(follower_id=a, followed_id=b, timestamp=moment()) for a, b in sorted(pairs))
+    yield timed('follow', lambda: _bulk_insert(Follow.__table__, follows(), chunk_size))
+
+    tag_names = list(dict.fromkeys(fake.word() for _ in range(sizes['tag'])))  # 去重并保持顺序
+    tag_names += ['tag%d' % i for i in range(len(tag_names), sizes['tag'])]
+    yield timed('tag', lambda: _bulk_insert(Tag.__table__, (dict(id=i, name=name, dish_count=0)
+                                                             for i, name in enumerate(tag_names, 1)), chunk_size))
+
+    shop_users = [rng.randint(1, users) for _ in range(shops)]
+    yield timed('shop', lambda: _bulk_insert(Shop.__table__, (dict(
+        id=i, name=rng.choice(names), tel=str(15000000000 + i), user_id=shop_users[i - 1], deleted=False,
+        location_x=rng.randint(0, 1000), location_y=rng.randint(0, 1000)) for i in range(1, shops + 1)), chunk_size))
+
+    blobs = []  # (id, 文件名, 大小, 小图, 中图)
+
+    def images():
+        with Pool(processes, initializer=_init_image_worker) as pool:
+            results = pool.map(_forge_image, [(seed, i) for i in range(max(1, min(sizes['image'], dishes)))])
+        digests, rows = set(), []
+        for digest, filename, size, filename_s, filename_m in results:
+            if digest not in digests:  # 颜色相同的图片内容相同
+                digests.add(digest)
+                blobs.append((len(blobs) + 1, filename, size, filename_s, filename_m))
+                rows.append(dict(id=len(blobs), digest=digest, filename=filename, size=size, refcount=0, timestamp=now))
+        return _bulk_insert(Blob.__table__, rows, chunk_size)
+    yield timed('image', images)
+
+    dish_shops = [rng.randint(1, shops) for _ in range(dishes)]
+    yield timed('dish', lambda: _bulk_insert(Dish.__table__, (dict(
+        id=i, name=rng.choice(names), description=rng.choice(texts), price=rng.randint(10, 100),
+        timestamp=moment(), shop_id=dish_shops[i - 1], sales=0, collect_count=0, comment_count=0)
+        for i in range(1, dishes + 1)), chunk_size))
+
+    def files():
+        for i in range(1, dishes + 1):
+            id, filename, size, filename_s, filename_m = blobs[i % len(blobs)]
+            yield dict(id=i, filename=filename, filename_s=filename_s, filename_m=filename_m, blob_id=id,
+                       dish_id=i, user_id=shop_users[dish_shops[i - 1] - 1], is_use=True, is_img=True,
+                       timestamp=now)
+    yield timed('file', lambda: _bulk_insert(File.__table__, files(), chunk_size))
+
+    def taggings():
+        for i in range(1, dishes + 1):
+            for tag_id in set(rng.randint(1, len(tag_names)) for _ in range(rng.randint(1, 5))):
+                yield dict(dish_id=i, tag_id=tag_id)
+    yield timed('tagging', lambda: _bulk_insert(tagging, taggings(), chunk_size))
+
+    def collects():
+        pairs = {(rng.randint(1, users), rng.randint(1, dishes)) for _ in range(sizes['collect'])}
+        return (dict(collector_id=a, collected_id=b, timestamp=moment()) for a, b in pairs)
+    yield timed('collect', lambda: _bulk_insert(Collect.__table__, collects(), chunk_size))
+
+    yield timed('comment', lambda: _bulk_insert(Comment.__table__, (dict(
+        id=i, body=rng.choice(sentences), timestamp=moment(), author_id=rng.randint(1, users),
+        dish_id=rng.randint(1, dishes)) for i in range(1, sizes['comment'] + 1)), chunk_size))
+
+    # 每个订单的下单人和送达时间(距now的秒数)，用于生成送达消息
+    order_consumers, order_delivered = array('i'), array('i')
+    sales, income = array('i', [0]) * (dishes + 1), array('i', [0]) * (users + 1)  # 按下标计数
+
+    def order_rows():
+        for i in range(1, orders + 1):
+            dish_id, ago = rng.randint(1, dishes), rng.randint(0, year)
+            fare, number, consumer_id = rng.randint(1, 50), rng.randint(1, 10), rng.randint(1, users)
+            rider_id = rng.randint(1, users)
+            order_consumers.append(consumer_id)
+            order_delivered.append(ago - fare)
+            sales[dish_id] += 1
+            income[rider_id] += fare
+            yield dict(id=i, dish_id=dish_id, shop_id=dish_shops[dish_id - 1], consumer_id=consumer_id,
+                       rider_id=rider_id, price=rng.randint(10, 100) * number + fare, number=number,
+                       fare=fare, location_x=rng.randint(0, 1000), location_y=rng.randint(0, 1000),
+                       is_finish=True, start_time=now - timedelta(seconds=ago),
+                       time=now - timedelta(seconds=ago - fare))
+    yield timed('order', lambda: _bulk_insert(Order.__table__, order_rows(), chunk_size))
+
+    def notifications():
+        with current_app.test_request_context():  # 消息里的订单链接
+            for i in range(1, sizes['notification'] + 1):
+                order_id = rng.randint(1, orders)
+                delivered = now - timedelta(seconds=order_delivered[order_id - 1])
+                message = 'Your order<a href="%s">%s</a> has been delivered! \n %s' % \
+                          (url_for('user.show_order', order_id=order_id), order_id, delivered)
+                yield dict(id=i, message=message, is_read=rng.random() < 0.8, timestamp=delivered,
+                           receiver_id=order_consumers[order_id - 1])
+    if orders:
+        yield timed('notification', lambda: _bulk_insert(Notification.__table__, notifications(), chunk_size))
+
+    def totals():
+        for table, column, values in ((Dish.__table__, 'sales', sales), (Rider.__table__, 'income', income)):
+            for chunk in _chunks(({'_id': pk, '_value': value} for pk, value in enumerate(values) if value),
+                                 chunk_size):
+                db.session.execute(table.update().where(table.c.id == bindparam('_id'))
+                                   .values({column: bindparam('_value')}), chunk)
+            db.session.commit()
+        return dishes + users
+    yield timed('sales and income', totals)
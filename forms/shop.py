@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, StringField, SubmitField, TextAreaField, ValidationError
+from wtforms import HiddenField, IntegerField, StringField, SubmitField, TextAreaField, ValidationError
 from wtforms.validators import DataRequired, Optional, Length
 
 
@@ -26,6 +26,7 @@ class DishForm(FlaskForm):
     price = IntegerField('price', validators=[DataRequired()])
     description = TextAreaField('Description', validators=[Optional(), Length(0, 500)])
     tag = StringField('Add Tag (use space to separate)', validators=[Optional(), Length(0, 64)])
+    upload_session = HiddenField(validators=[Optional(), Length(0, 32)])
     submit = SubmitField()
 
     def validate_number(self, field):
@@ -0,0 +1,144 @@
+import threading
+import time
+from heapq import nsmallest
+
+
+def manhattan(x1, y1, x2, y2):
+    """曼哈顿距离，与计算运费的公式一致"""
+    return abs(x1 - x2) + abs(y1 - y2)
+
+
+class GridIndex(object):
+    """网格空间索引
+
+    把点按坐标分到边长为cell_size的网格中，最近邻查询从所在网格开始一圈圈向外扩展，
+    找够k个且第k个的距离不超过已搜索范围时即可停止，结果是精确的。
+    """
+
+    def __init__(self, config_prefix, app=None):
+        self.config_prefix = config_prefix
+        self.cell_size = 100
+        self.ttl = None
+        self.loaded_at = None
+        self._cells = {}  # (cx, cy) -> {id: (x, y)}
+        self._points = {}  # id -> (cx, cy)
+        self._bounds = None  # 出现过的网格坐标范围 [min_cx, min_cy, max_cx, max_cy]
+        self._lock = threading.RLock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cell_size = app.config.get(self.config_prefix + '_CELL', self.cell_size)
+        self.ttl = app.config.get(self.config_prefix + '_TTL')
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def expired(self):
+        """未加载过或超过ttl秒未与数据库同步"""
+        if self.loaded_at is None:
+            return True
+        return self.ttl is not None and time.time() - self.loaded_at > self.ttl
+
+    def expire(self):
+        self.loaded_at = None
+
+    def cell(self, x, y):
+        return x // self.cell_size, y // self.cell_size
+
+    def load(self, points):
+        """用(id, x, y)序列整体替换索引内容"""
+        with self._lock:
+            self._cells = {}
+            self._points = {}
+            self._bounds = None
+            for id, x, y in points:
+                self._insert(id, x, y)
+            self.loaded_at = time.time()
+
+    def insert(self, id, x, y):
+        with self._lock:
+            self._remove(id)
+            self._insert(id, x, y)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _insert(self, id, x, y):
+        if x is None or y is None:
+            return
+        key = self.cell(x, y)
+        self._cells.setdefault(key, {})[id] = (x, y)
+        self._points[id] = key
+        if self._bounds is None:
+            self._bounds = [key[0], key[1], key[0], key[1]]
+        else:
+            b = self._bounds
+            b[0], b[1] = min(b[0], key[0]), min(b[1], key[1])
+            b[2], b[3] = max(b[2], key[0]), max(b[3], key[1])
+
+    def _remove(self, id):
+        key = self._points.pop(id, None)
+        if key is None:
+            return
+        bucket = self._cells[key]
+        del bucket[id]
+        if not bucket:
+            del self._cells[key]
+
+    def _ring(self, cx, cy, r):
+        """与(cx, cy)切比雪夫距离恰为r的一圈网格"""
+        if r == 0:
+            yield cx, cy
+            return
+        for i in range(cx - r, cx + r + 1):
+            yield i, cy - r
+            yield i, cy + r
+        for j in range(cy - r + 1, cy + r):
+            yield cx - r, j
+            yield cx + r, j
+
+    def nearest(self, x, y, k=1):
+        """返回离(x, y)最近的k个点，按距离升序排列的[(距离, id), ...]"""
+        with self._lock:
+            if not self._points:
+                return []
+            cx, cy = self.cell(x, y)
+            b = self._bounds
+            max_r = max(cx - b[0], cy - b[1], b[2] - cx, b[3] - cy, 0)
+            found = []
+            r = 0
+            while r <= max_r:
+                for key in self._ring(cx, cy, r):
+                    bucket = self._cells.get(key)
+                    if bucket:
+                        found.extend((manhattan(x, y, px, py), id) for id, (px, py) in bucket.items())
+                # 第r+1圈及以外的点距离都大于r * cell_size
+                if len(found) >= k and nsmallest(k, found)[-1][0] <= r * self.cell_size:
+                    break
+                r += 1
+            return nsmallest(k, found)
+
+    def within(self, x, y, radius):
+        """返回曼哈顿距离不超过radius的所有点，按距离升序排列"""
+        with self._lock:
+            min_cx, min_cy = self.cell(x - radius, y - radius)
+            max_cx, max_cy = self.cell(x + radius, y + radius)
+            if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self._cells):
+                keys = [key for key in self._cells
+                        if min_cx <= key[0] <= max_cx and min_cy <= key[1] <= max_cy]
+            else:
+                keys = [(i, j) for i in range(min_cx, max_cx + 1) for j in range(min_cy, max_cy + 1)]
+            found = []
+            for key in keys:
+                bucket = self._cells.get(key)
+                if not bucket:
+                    continue
+                for id, (px, py) in bucket.items():
+                    distance = manhattan(x, y, px, py)
+                    if distance <= radius:
+                        found.append((distance, id))
+            found.sort()
+            return found
@@ -0,0 +1,145 @@
+import threading
+from multiprocessing import Pool
+
+from sqlalchemy import event
+from whoosh.index import LockError
+from whoosh.writing import CLEAR
+
+from .extensions import db, whooshee
+from .tasks import PeriodicWorker
+
+
+def _whoosheer_of(instance):
+    return getattr(type(instance), '_whoosheer_', None)
+
+
+def _index_changed(instance, whoosheer):
+    """对象的被索引字段是否有改动"""
+    attrs = db.inspect(instance).attrs
+    return any(attrs[name].history.has_changes() for name in whoosheer.schema.names() if name in attrs)
+
+
+class SearchIndexer(PeriodicWorker):
+    """后台批量更新全文索引
+
+    关闭whooshee在flush时同步写索引(WHOOSHEE_ENABLE_INDEXING = False)，改为在事务提交后
+    把被改动对象的(模型, id)放进队列，每隔YGQ_SEARCH_INDEX_TICK秒由后台线程合并写入，
+    每个索引一批只打开一次writer。索引的延迟不超过一个周期，请求不再等待索引的写锁。
+    只记录被索引字段有改动的对象，例如下单时更新销量不会触发索引。
+    写锁被其他进程占用时把这一批放回队列，下个周期重试。
+    """
+    name = 'ygq_search_indexer'
+    interval_key = 'YGQ_SEARCH_INDEX_TICK'
+
+    def __init__(self, app=None):
+        self._pending = {}  # (模型, id) -> 是否已删除
+        self._pending_lock = threading.Lock()
+        super(SearchIndexer, self).__init__(app)
+
+    def init_app(self, app):
+        super(SearchIndexer, self).init_app(app)
+        if app.config['WHOOSHEE_ENABLE_INDEXING']:  # whooshee自己同步写索引
+            return
+        for name, listener in (('after_flush', self.collect_changes),
+                               ('after_commit', self.queue_changes),
+                               ('after_rollback', self.discard_changes)):
+            if not event.contains(db.session, name, listener):
+                event.listen(db.session, name, listener)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def collect_changes(self, session, flush_context):
+        changes = session.info.setdefault('search_index_changes', {})
+        for instance in session.new | session.dirty:
+            whoosheer = _whoosheer_of(instance)
+            if whoosheer is not None and (instance in session.new or _index_changed(instance, whoosheer)):
+                changes[type(instance), instance.id] = False
+        for instance in session.deleted:
+            if _whoosheer_of(instance) is not None:
+                changes[type(instance), instance.id] = True
+
+    def index_later(self, session, model, ids, deleted=False):
+        """不经过ORM批量插入或删除的记录，在事务提交后更新索引"""
+        if self.app is None or self.app.config['WHOOSHEE_ENABLE_INDEXING']:
+            return
+        changes = session.info.setdefault('search_index_changes', {})
+        changes.update(((model, pk), deleted) for pk in ids)
+
+    def queue_changes(self, session):
+        changes = session.info.pop('search_index_changes', None)
+        if changes:
+            with self._pending_lock:
+                self._pending.update(changes)
+
+    def discard_changes(self, session):
+        session.info.pop('search_index_changes', None)
+
+    def tick(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.apply(pending)
+        except LockError:
+            with self._pending_lock:  # 新的改动优先
+                pending.update(self._pending)
+                self._pending = pending
+            self.app.logger.info('Search index is locked, %d changes deferred.', len(pending))
+
+    def apply(self, pending):
+        timeout = self.app.config['YGQ_SEARCH_INDEX_WRITER_TIMEOUT']
+        for whoosheer in whooshee.whoosheers:
+            batch = [(model, pk, deleted) for (model, pk), deleted in pending.items() if model in whoosheer.models]
+            if not batch:
+                continue
+            index = whooshee.get_or_create_index(self.app, whoosheer)
+            with index.writer(timeout=timeout) as writer:
+                for model in whoosheer.models:
+                    ids = [pk for m, pk, deleted in batch if m is model]
+                    alive = [pk for m, pk, deleted in batch if m is model and not deleted]
+                    update = getattr(whoosheer, 'update_%s' % model.__name__.lower())
+                    found = set()
+                    for instance in model.query.filter(model.id.in_(alive)).all() if alive else ():
+                        update(writer, instance)
+                        found.add(instance.id)
+                    for pk in ids:
+                        if pk not in found:  # 已删除，或者在排队期间被删除
+                            writer.delete_by_term('id', pk)
+
+
+def _rebuild_index(position):
+    """在子进程中重建第position个索引"""
+    from . import create_app
+    app = create_app()
+    with app.app_context():
+        return rebuild_index(app, whooshee.whoosheers[position])
+
+
+def rebuild_index(app, whoosheer, chunk_size=1000):
+    """清空并重建一个索引，返回写入的文档数"""
+    index = whooshee.get_or_create_index(app, whoosheer)
+    writer = index.writer(timeout=app.config['YGQ_SEARCH_INDEX_WRITER_TIMEOUT'])
+    count = 0
+    for model in whoosheer.models:
+        insert = getattr(whoosheer, 'insert_%s' % model.__name__.lower())
+        for instance in model.query.order_by(model.id).yield_per(chunk_size):
+            insert(writer, instance)
+            count += 1
+    writer.commit(mergetype=CLEAR)
+    return count
+
+
+def rebuild_indexes(app, processes=None):
+    """重建所有索引，每个索引一个进程；使用内存索引时只能在当前进程里重建"""
+    whoosheers = whooshee.whoosheers
+    if app.config.get('WHOOSHEE_MEMORY_STORAGE') or processes == 1:
+        counts = [rebuild_index(app, whoosheer) for whoosheer in whoosheers]
+    else:
+        with Pool(processes or len(whoosheers)) as pool:
+            counts = pool.map(_rebuild_index, range(len(whoosheers)))
+    return [(whoosheer.index_subdir, count) for whoosheer, count in zip(whoosheers, counts)]
+
+
+indexer = SearchIndexer()
@@ -0,0 +1,26 @@
+# 列表页的预加载方案，避免模板逐行访问关系时产生N+1查询
+from sqlalchemy.orm import joinedload, selectinload
+
+from .models import Dish, Shop, Order, Comment, Collect
+
+# 菜品卡片：图片、店铺和店主头像
+dish_card = (
+    selectinload(Dish.files),
+    joinedload(Dish.shop).joinedload(Shop.user),
+)
+
+# 订单卡片：菜品及其图片
+order_card = (
+    joinedload(Order.dish).selectinload(Dish.files),
+)
+
+# 收藏列表：被收藏的菜品及其图片
+collect_card = (
+    joinedload(Collect.collected).selectinload(Dish.files),
+)
+
+# 评论列表：作者以及被回复评论的作者
+comment_list = (
+    joinedload(Comment.author),
+    joinedload(Comment.replied).joinedload(Comment.author),
+)
@@ -1,13 +1,11 @@
-import os
 from datetime import datetime
 
 
-from flask import current_app
 from flask_avatars import Identicon
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from .extensions import db, whooshee
+from .extensions import db, whooshee, rider_index, shop_index, page_cache, autocomplete_index
 
 
 class Follow(db.Model):
@@ -15,7 +13,7 @@ class Follow(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     follower = db.relationship('User', foreign_keys=[follower_id], back_populates='following', lazy='joined')
 
-    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
     followed = db.relationship('User', foreign_keys=[followed_id], back_populates='followers', lazy='joined')
 
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -23,6 +21,11 @@ class Follow(db.Model):
 
 class Collect(db.Model):
     """收藏模型"""
+    __table_args__ = (
+        db.Index('ix_collect_collector_timestamp', 'collector_id', 'timestamp', 'collected_id'),
+        db.Index('ix_collect_collected', 'collected_id'),
+    )
+
     collector_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     collector = db.relationship('User', back_populates='collections', lazy='joined')
 
@@ -49,12 +52,14 @@ class User(db.Model, UserMixin):
     avatar_raw = db.Column(db.String(64))  # 头像原图
 
     confirmed = db.Column(db.Boolean, default=False)
+    deleted = db.Column(db.Boolean, default=False, nullable=False)  # 墓碑，相关记录由后台任务分批删除
 
     shops = db.relationship('Shop', back_populates='user', cascade='all')
     rider = db.relationship('Rider', back_populates='user', cascade='all')
     orders = db.relationship('Order', back_populates='consumer')
     comments = db.relationship('Comment', back_populates='author', cascade='all')
     notifications = db.relationship('Notification', back_populates='receiver', cascade='all')
+    unread_notifications = db.Column(db.Integer, default=0, nullable=False)  # 未读消息数，由Notification的事件维护
     files = db.relationship('File', back_populates='user', cascade='all')
     collections = db.relationship('Collect', back_populates='collector', cascade='all')
     following = db.relationship('Follow', foreign_keys=[Follow.follower_id], back_populates='follower',
@@ -129,9 +134,10 @@ class Shop(db.Model):
     location_y = db.Column(db.Integer)
     name = db.Column(db.String(30))
     tel = db.Column(db.String(11), unique=True)
+    deleted = db.Column(db.Boolean, default=False, nullable=False)  # 墓碑
     dishes = db.relationship('Dish', back_populates='shop', cascade='all')
     orders = db.relationship('Order', back_populates='shop', cascade='all')
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User', back_populates='shops')
 
 
@@ -140,10 +146,22 @@ class Rider(db.Model):
     location_x = db.Column(db.Integer)
     location_y = db.Column(db.Integer)
     orders = db.relationship('Order', back_populates='rider')
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User', back_populates='rider')
     income = db.Column(db.Integer, default=0)
-    active = db.Column(db.Boolean, default=False)
+    active = db.Column(db.Boolean, default=False, index=True)
+    busy = db.Column(db.Boolean, default=False, nullable=False, index=True)  # 正在送单，订单送达后释放
+
+    def claim(self, fare):
+        """接单：仅当骑手在线且空闲时成功，把骑手标记为忙碌并在数据库里原子地增加收入
+
+        条件更新同时检查和占用骑手，并发的请求或进程中只有一个能接到同一个骑手。
+        """
+        claimed = Rider.query.filter_by(id=self.id, active=True, busy=False).update(
+            {Rider.busy: True, Rider.income: Rider.income + fare},
+            synchronize_session=False)
+        db.session.expire(self, ['busy', 'income'])
+        return claimed == 1
 
     def to_active(self):
         self.active = True
@@ -155,6 +173,12 @@ class Rider(db.Model):
 
 
 class Order(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_consumer_start_time', 'consumer_id', 'start_time', 'id'),
+        db.Index('ix_order_rider_start_time', 'rider_id', 'start_time', 'id'),
+        db.Index('ix_order_shop_start_time', 'shop_id', 'start_time', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'))
     dish = db.relationship('Dish', back_populates='orders')
@@ -167,19 +191,29 @@ class Order(db.Model):
     price = db.Column(db.Integer)
     number = db.Column(db.Integer)
     fare = db.Column(db.Integer)
-    is_finish = db.Column(db.Boolean, default=False)
+    location_x = db.Column(db.Integer)  # 送货地址
+    location_y = db.Column(db.Integer)
+    is_finish = db.Column(db.Boolean, default=False, index=True)
     start_time = db.Column(db.DateTime, default=datetime.utcnow)
     time = db.Column(db.DateTime)
 
 
 tagging = db.Table('tagging',
                    db.Column('dish_id', db.Integer, db.ForeignKey('dish.id')),
-                   db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+                   db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
+                   db.Index('ix_tagging_tag_dish', 'tag_id', 'dish_id'),
+                   db.Index('ix_tagging_dish', 'dish_id')
                    )
 
 
 @whooshee.register_model('description')
 class Dish(db.Model):
+    __table_args__ = (
+        db.Index('ix_dish_sales', 'sales', 'id'),
+        db.Index('ix_dish_collect_count', 'collect_count', 'id'),
+        db.Index('ix_dish_shop_timestamp', 'shop_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
     price = db.Column(db.Integer)
@@ -188,12 +222,19 @@ class Dish(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'))
     shop = db.relationship('Shop', back_populates='dishes')
-    files = db.relationship('File', back_populates='dish')
+    files = db.relationship('File', back_populates='dish', cascade='all, delete-orphan')
     orders = db.relationship('Order', back_populates='dish')
     comments = db.relationship('Comment', back_populates='dish', cascade='all')
     collectors = db.relationship('Collect', back_populates='collected', cascade='all')
     tags = db.relationship('Tag', secondary=tagging, back_populates='dishes')
     sales = db.Column(db.Integer, default=0)
+    collect_count = db.Column(db.Integer, default=0, nullable=False)  # 收藏数，由Collect的事件维护
+    comment_count = db.Column(db.Integer, default=0, nullable=False)  # 评论数，由Comment的事件维护
+
+    @classmethod
+    def visible(cls):
+        """列表中显示的菜品：所属店铺没有被删除(删除任务完成前店铺和菜品还在表里)"""
+        return ~cls.shop.has(Shop.deleted == True)
 
 
 @whooshee.register_model('name')
@@ -201,19 +242,64 @@ class Tag(db.Model):
     """商品标签"""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
+    dish_count = db.Column(db.Integer, default=0, nullable=False, index=True)  # 菜品数，用于热门标签排行
 
     dishes = db.relationship('Dish', secondary=tagging, back_populates='tags')
 
 
+class Blob(db.Model):
+    """按内容存储的上传文件，内容相同的上传共用一个文件"""
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256
+    filename = db.Column(db.String(80), nullable=False)
+    size = db.Column(db.Integer)
+    refcount = db.Column(db.Integer, default=0, nullable=False)  # 引用它的File数，由File的事件维护
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    files = db.relationship('File', back_populates='blob')
+
+
+class DeletedFile(db.Model):
+    """待删除文件的日志，和删除记录在同一个事务里写入，由后台任务在提交后删除磁盘上的文件"""
+    id = db.Column(db.Integer, primary_key=True)
+    folder = db.Column(db.String(30), nullable=False)  # 目录的配置项，如YGQ_UPLOAD_PATH
+    filename = db.Column(db.String(80), nullable=False, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # 删除失败的次数
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DeletionJob(db.Model):
+    """删除用户或店铺的后台任务，按阶段分批删除依赖的记录"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # user; shop
+    target_id = db.Column(db.Integer, nullable=False)
+    stage = db.Column(db.String(20))  # 正在删除的内容
+    deleted = db.Column(db.Integer, default=0, nullable=False)  # 已删除(或解除关联)的行数
+    batches = db.Column(db.Integer, default=0, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, index=True)
+
+
 class File(db.Model):
+    __table_args__ = (
+        db.Index('ix_file_user_session_is_use', 'user_id', 'session', 'is_use'),
+        db.Index('ix_file_is_use_timestamp', 'is_use', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(64))
-    dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'))
+    filename = db.Column(db.String(80))
+    filename_s = db.Column(db.String(80), index=True)  # 缩略图，由后台任务生成
+    filename_m = db.Column(db.String(80))
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
+    blob = db.relationship('Blob', back_populates='files')
+    dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'), index=True)
     dish = db.relationship('Dish', back_populates='files')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', back_populates='files')
     is_use = db.Column(db.Boolean, default=False)
     is_img = db.Column(db.Boolean, default=True)
+    session = db.Column(db.String(32))  # 上传会话，发布菜品时只认领同一会话上传的文件
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class Comment(db.Model):
@@ -221,10 +307,10 @@ class Comment(db.Model):
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
-    author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     author = db.relationship('User', back_populates='comments')
-    dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'))
+    dish_id = db.Column(db.Integer, db.ForeignKey('dish.id'), index=True)
     dish = db.relationship('Dish', back_populates='comments')
 
     replies = db.relationship('Comment', back_populates='replied', cascade='all')
@@ -232,30 +318,223 @@ class Comment(db.Model):
 
 
 class Notification(db.Model):
+    __table_args__ = (
+        db.Index('ix_notification_receiver_timestamp', 'receiver_id', 'timestamp', 'id'),
+        db.Index('ix_notification_receiver_is_read', 'receiver_id', 'is_read'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.Text, nullable=False)
+    is_read = db.Column(db.Boolean, default=False, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 接收者
     receiver = db.relationship('User', back_populates='notifications')
 
 
+def journal_files(connection, session, folder, filenames):
+    """记录要删除的文件，事务回滚时日志也一起回滚"""
+    rows = [dict(folder=folder, filename=filename, attempts=0, timestamp=datetime.utcnow())
+            for filename in set(filenames) if filename]
+    if rows:
+        connection.execute(DeletedFile.__table__.insert(), rows)
+        session.info['deleted_files'] = True
+
+
+def _unjournal_files(connection, folder, condition):
+    """同名文件又被使用时撤销还没执行的删除"""
+    table = DeletedFile.__table__
+    connection.execute(table.delete().where(db.and_(table.c.folder == folder, condition(table.c.filename))))
+
+
 @db.event.listens_for(User, 'after_delete', named=True)
 def delete_avatars(**kwargs):
     """删除头像文件的监听函数"""
     target = kwargs['target']
-    for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
-        if filename is not None:  # avatar_raw may be None
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):  # not every filename map a unique file
-                os.remove(path)
+    journal_files(kwargs['connection'], db.object_session(target), 'AVATARS_SAVE_PATH',
+                   [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw])
+
+
+@db.event.listens_for(User, 'after_insert', named=True)
+def keep_avatars(**kwargs):
+    # 头像文件名由用户名生成，重新注册同名用户时会覆盖原来的文件
+    target = kwargs['target']
+    filenames = [name for name in (target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw) if name]
+    if filenames:
+        _unjournal_files(kwargs['connection'], 'AVATARS_SAVE_PATH', lambda column: column.in_(filenames))
+
+
+@db.event.listens_for(Blob, 'after_insert', named=True)
+def keep_blob_files(**kwargs):
+    # 已经删除的内容又被上传，原图和缩略图都以摘要开头
+    _unjournal_files(kwargs['connection'], 'YGQ_UPLOAD_PATH',
+                     lambda column: column.startswith(kwargs['target'].digest))
+
+
+@db.event.listens_for(File, 'after_insert', named=True)
+def increase_blob_refcount(**kwargs):
+    target = kwargs['target']
+    if target.blob_id is not None:
+        table = Blob.__table__
+        kwargs['connection'].execute(
+            table.update().where(table.c.id == target.blob_id).values(refcount=table.c.refcount + 1))
+
+
+@db.event.listens_for(File, 'after_delete', named=True)
+def decrease_blob_refcount(**kwargs):
+    """删除最后一个引用时删除Blob，文件记入删除日志"""
+    target, connection = kwargs['target'], kwargs['connection']
+    if target.blob_id is not None:
+        table = Blob.__table__
+        connection.execute(table.update().where(table.c.id == target.blob_id).values(refcount=table.c.refcount - 1))
+        if not connection.execute(table.delete().where(db.and_(table.c.id == target.blob_id,
+                                                               table.c.refcount <= 0))).rowcount:
+            return
+    # 没有Blob的是按内容存储之前上传的文件，只属于这一个File
+    journal_files(connection, db.object_session(target), 'YGQ_UPLOAD_PATH',
+                   [target.filename, target.filename_s, target.filename_m])
+
+
+def _update_dish_count(connection, dish_id, column, delta):
+    table = Dish.__table__
+    connection.execute(table.update().where(table.c.id == dish_id).values({column: table.c[column] + delta}))
+
+
+@db.event.listens_for(Collect, 'after_insert', named=True)
+def increase_collect_count(**kwargs):
+    _update_dish_count(kwargs['connection'], kwargs['target'].collected_id, 'collect_count', 1)
+
+
+@db.event.listens_for(Collect, 'after_delete', named=True)
+def decrease_collect_count(**kwargs):
+    _update_dish_count(kwargs['connection'], kwargs['target'].collected_id, 'collect_count', -1)
+
+
+@db.event.listens_for(Comment, 'after_insert', named=True)
+def increase_comment_count(**kwargs):
+    _update_dish_count(kwargs['connection'], kwargs['target'].dish_id, 'comment_count', 1)
+
+
+@db.event.listens_for(Comment, 'after_delete', named=True)
+def decrease_comment_count(**kwargs):
+    _update_dish_count(kwargs['connection'], kwargs['target'].dish_id, 'comment_count', -1)
+
+
+def _update_unread_notifications(connection, user_id, delta):
+    table = User.__table__
+    connection.execute(table.update().where(table.c.id == user_id)
+                       .values(unread_notifications=table.c.unread_notifications + delta))
+
+
+@db.event.listens_for(Notification, 'after_insert', named=True)
+def increase_unread_notifications(**kwargs):
+    target = kwargs['target']
+    if not target.is_read:
+        _update_unread_notifications(kwargs['connection'], target.receiver_id, 1)
+
+
+@db.event.listens_for(Notification, 'after_delete', named=True)
+def decrease_unread_notifications(**kwargs):
+    target = kwargs['target']
+    if not target.is_read:
+        _update_unread_notifications(kwargs['connection'], target.receiver_id, -1)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def update_tag_dish_count(session, flush_context):
+    """菜品添加、移除标签或被删除时维护Tag.dish_count"""
+    deltas = {}
+    for dish in session.new | session.dirty | session.deleted:
+        if not isinstance(dish, Dish):
+            continue
+        added, unchanged, deleted = [list(tags or ()) for tags in db.inspect(dish).attrs.tags.history]
+        if dish in session.deleted:
+            changes = [(tag, -1) for tag in unchanged + deleted]
+        else:
+            changes = [(tag, 1) for tag in added] + [(tag, -1) for tag in deleted]
+        for tag, delta in changes:
+            deltas[tag.id] = deltas.get(tag.id, 0) + delta
+    table = Tag.__table__
+    for tag_id, delta in deltas.items():
+        if delta:
+            session.execute(table.update().where(table.c.id == tag_id).values(dish_count=table.c.dish_count + delta))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def mark_page_cache_dirty(session, flush_context):
+    """记录本事务是否改动了未登录用户页面上展示的内容"""
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, (Dish, Comment, Collect, Tag, Shop)):
+            session.info['page_cache_dirty'] = True
+            break
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_page_cache(session):
+    if session.info.pop('page_cache_dirty', False):
+        page_cache.invalidate()
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_page_cache_dirty(session):
+    session.info.pop('page_cache_dirty', None)
+
+
+@db.event.listens_for(Rider, 'after_insert', named=True)
+@db.event.listens_for(Rider, 'after_update', named=True)
+def update_rider_index(**kwargs):
+    """骑手上线、下线或位置变化时同步空间索引"""
+    target = kwargs['target']
+    if target.active:
+        rider_index.insert(target.id, target.location_x, target.location_y)
+    else:
+        rider_index.remove(target.id)
+
+
+@db.event.listens_for(Rider, 'after_delete', named=True)
+def remove_rider_index(**kwargs):
+    rider_index.remove(kwargs['target'].id)
+
+
+@db.event.listens_for(Shop, 'after_insert', named=True)
+@db.event.listens_for(Shop, 'after_update', named=True)
+def update_shop_index(**kwargs):
+    """店铺开张、位置变化或被删除时同步空间索引"""
+    target = kwargs['target']
+    if target.deleted:
+        shop_index.remove(target.id)
+    else:
+        shop_index.insert(target.id, target.location_x, target.location_y)
+
+
+@db.event.listens_for(Shop, 'after_delete', named=True)
+def remove_shop_index(**kwargs):
+    shop_index.remove(kwargs['target'].id)
+
+
+@db.event.listens_for(Tag, 'after_insert', named=True)
+@db.event.listens_for(Dish, 'after_insert', named=True)
+@db.event.listens_for(Shop, 'after_insert', named=True)
+def insert_autocomplete(**kwargs):
+    """新的标签、菜品和店铺加入前缀索引"""
+    target = kwargs['target']
+    autocomplete_index.insert(target.__tablename__, target.id, target.name)
+
+
+@db.event.listens_for(Tag, 'after_update', named=True)
+@db.event.listens_for(Dish, 'after_update', named=True)
+@db.event.listens_for(Shop, 'after_update', named=True)
+def update_autocomplete(**kwargs):
+    target = kwargs['target']
+    if getattr(target, 'deleted', False):
+        autocomplete_index.remove(target.__tablename__, target.id)
+    elif db.inspect(target).attrs.name.history.has_changes():
+        autocomplete_index.insert(target.__tablename__, target.id, target.name)
 
 
+@db.event.listens_for(Tag, 'after_delete', named=True)
 @db.event.listens_for(Dish, 'after_delete', named=True)
-def delete_photos(**kwargs):
-    """图片删除事件监听函数"""
+@db.event.listens_for(Shop, 'after_delete', named=True)
+def remove_autocomplete(**kwargs):
     target = kwargs['target']
-    for file in target.files:
-        path = os.path.join(current_app.config['YGQ_UPLOAD_PATH'], file.filename)
-        if os.path.exists(path):  # not every filename map a unique file
-            os.remove(path)
+    autocomplete_index.remove(target.__tablename__, target.id)
@@ -0,0 +1,85 @@
+from flask import current_app
+
+from .cache import LRUBackend
+from .dispatch import load_rider_index, compute_fare
+from .extensions import db, rider_index, shop_index
+from .geo import manhattan
+from .models import Dish, Shop
+
+
+def load_shop_index():
+    """从数据库重建店铺的空间索引"""
+    shop_index.load(db.session.query(Shop.id, Shop.location_x, Shop.location_y).filter(Shop.deleted == False))
+
+
+class NearbyDishes(object):
+    """附近的菜品
+
+    同一网格内的用户共享一份候选：以网格中心为圆心、半径加上网格中心到角的距离(一个网格边长)
+    从店铺空间索引中取出店铺，连同它们的菜品缓存YGQ_NEARBY_CACHE_TIMEOUT秒，
+    网格内任意位置半径内的店铺都在候选里。每个请求再用用户的实际坐标过滤半径，
+    并按下单时的运费公式(dispatch.compute_fare，最近骑手到用户的距离 + 店铺到用户的距离)排序，
+    翻页只是对排序结果切片，再按id取出当页的菜品。
+    """
+    max_ids = 500  # 单次IN查询的参数个数上限，SQLite默认最多999个
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUBackend(current_app.config['YGQ_NEARBY_CACHE_SIZE'])
+        return self._cache
+
+    def center(self, x, y):
+        cell_size = shop_index.cell_size
+        cx, cy = shop_index.cell(x, y)
+        return cx * cell_size + cell_size // 2, cy * cell_size + cell_size // 2
+
+    def candidates(self, x, y):
+        """(x, y)所在网格的候选菜品[(菜品id, 销量, 店铺x, 店铺y)]"""
+        cx, cy = self.center(x, y)
+        key = '%d:%d' % (cx, cy)
+        candidates = self.cache.get(key)
+        if candidates is not None:
+            return candidates
+
+        if shop_index.expired:
+            load_shop_index()
+        radius = current_app.config['YGQ_NEARBY_RADIUS'] + shop_index.cell_size
+        shop_ids = [id for _, id in shop_index.within(cx, cy, radius)]
+        candidates = []
+        for start in range(0, len(shop_ids), self.max_ids):
+            candidates.extend(db.session.query(Dish.id, Dish.sales, Shop.location_x, Shop.location_y)
+                              .join(Shop, Dish.shop_id == Shop.id)
+                              .filter(Shop.id.in_(shop_ids[start:start + self.max_ids])))
+        self.cache.set(key, candidates, current_app.config['YGQ_NEARBY_CACHE_TIMEOUT'])
+        return candidates
+
+    def rank(self, x, y):
+        """返回用户附近的[(运费, 店铺距离, 菜品id)]，按运费升序排列"""
+        if rider_index.expired:
+            load_rider_index()
+        riders = rider_index.nearest(x, y, 1)
+        rider_distance = riders[0][0] if riders else 0
+        radius = current_app.config['YGQ_NEARBY_RADIUS']
+        ranked = []
+        for dish in self.candidates(x, y):
+            distance = manhattan(dish.location_x, dish.location_y, x, y)
+            if distance <= radius:
+                ranked.append((compute_fare(dish, x, y, rider_distance), distance, -(dish.sales or 0), dish.id))
+        ranked.sort()
+        return [(fare, distance, id) for fare, distance, sales, id in ranked]
+
+    def page(self, x, y, page, per_page, *options):
+        """返回(总数, [(运费, 店铺距离, 菜品)])"""
+        page = max(page, 1)
+        ranked = self.rank(x, y)
+        chunk = ranked[(page - 1) * per_page:page * per_page]
+        dishes = {dish.id: dish for dish in
+                  Dish.query.options(*options).filter(Dish.id.in_([id for _, _, id in chunk]))} if chunk else {}
+        return len(ranked), [(fare, distance, dishes[id]) for fare, distance, id in chunk if id in dishes]
+
+
+nearby_dishes = NearbyDishes()
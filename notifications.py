@@ -1,22 +1,40 @@
 from flask import url_for
 
 from .extensions import db
-from .models import Notification
+from .models import Notification, User
 
 
-def push_new_order_notification(order, receiver):
+def push_new_order_notification(order, receiver, commit=True):
     """推送新订单消息"""
     message = 'You have a new order<a href="%s">%s</a>! \n %s' % \
               (url_for('user.show_order', order_id=order.id), order.id, order.start_time)
     notification = Notification(message=message, receiver=receiver, timestamp=order.start_time)
     db.session.add(notification)
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
 
-def push_delivered_notification(order):
+def push_delivered_notification(order, commit=True):
     """推送订单已送达消息"""
     message = 'Your order<a href="%s">%s</a> has been delivered! \n %s' % \
-              (url_for('user.show_order', order_id=order.id), order.id, order.start_time+order.time)
-    notification = Notification(message=message, receiver=order.consumer, timestamp=order.start_time+order.time)
+              (url_for('user.show_order', order_id=order.id), order.id, order.time)
+    notification = Notification(message=message, receiver=order.consumer, timestamp=order.time)
     db.session.add(notification)
+    if commit:
+        db.session.commit()
+
+
+def mark_notifications_read(user, ids=None):
+    """把user的未读消息(ids为None时为全部)标记为已读，返回本次标记的条数
+
+    用带is_read条件的UPDATE，同一条消息被并发标记时只会扣减一次未读数。
+    """
+    query = Notification.query.filter_by(receiver_id=user.id, is_read=False)
+    if ids is not None:
+        query = query.filter(Notification.id.in_(ids))
+    count = query.update({Notification.is_read: True}, synchronize_session=False)
+    if count:
+        User.query.filter_by(id=user.id).update(
+            {User.unread_notifications: User.unread_notifications - count}, synchronize_session=False)
     db.session.commit()
+    return count
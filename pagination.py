@@ -0,0 +1,78 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app, request, abort
+from sqlalchemy import and_, or_, DateTime
+
+
+def encode_cursor(values):
+    data = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = []
+        for value, column in zip(data, columns):
+            if value is not None and isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            values.append(value)
+    except (ValueError, TypeError):
+        abort(400)
+    if len(values) != len(columns):
+        abort(400)
+    return values
+
+
+def _seek(columns, values, older):
+    """按columns字典序排在values之后(older=True)或之前的行"""
+    column, value = columns[0], values[0]
+    beyond = column < value if older else column > value
+    if len(columns) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, _seek(columns[1:], values[1:], older)))
+
+
+class KeysetPagination(object):
+    """游标分页(seek method)
+
+    按columns降序排列，columns的最后一列必须能唯一确定一行(一般是主键)。
+    游标记录上一页最后一行(或下一页第一行)的排序键，翻页时用WHERE定位，
+    配合同样顺序的联合索引，任意一页的开销都和第一页相同。
+    没有总页数，只能上一页/下一页。
+    """
+    keyset = True
+
+    def __init__(self, query, columns, per_page, after=None, before=None):
+        self.per_page = per_page
+        self.items = None
+        if before:
+            rows = query.filter(_seek(columns, decode_cursor(before, columns), older=False)) \
+                .order_by(*[column.asc() for column in columns]).limit(per_page + 1).all()
+            if len(rows) > per_page:
+                self.has_prev = self.has_next = True
+                self.items = rows[:per_page][::-1]
+            else:  # 已经回到第一页，按第一页的方式取，保证条数完整
+                after = None
+        if self.items is None:
+            if after:
+                query = query.filter(_seek(columns, decode_cursor(after, columns), older=True))
+            rows = query.order_by(*[column.desc() for column in columns]).limit(per_page + 1).all()
+            self.has_prev = bool(after)
+            self.has_next = len(rows) > per_page
+            self.items = rows[:per_page]
+
+        keys = [tuple(getattr(item, column.key) for column in columns) for item in self.items]
+        self.prev_cursor = encode_cursor(keys[0]) if self.has_prev and keys else None
+        self.next_cursor = encode_cursor(keys[-1]) if self.has_next and keys else None
+
+
+def paginate(query, columns, per_page):
+    """按YGQ_PAGINATION_MODE返回游标分页，或者传统的页码分页"""
+    if current_app.config['YGQ_PAGINATION_MODE'] == 'keyset':
+        return KeysetPagination(query, columns, per_page,
+                                after=request.args.get('after'), before=request.args.get('before'))
+    page = request.args.get('page', 1, type=int)
+    return query.order_by(*[column.desc() for column in columns]).paginate(page, per_page)
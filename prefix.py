@@ -0,0 +1,76 @@
+import threading
+from bisect import bisect_left, insort
+
+
+class PrefixIndex(object):
+    """前缀索引
+
+    所有条目按(小写名称, 类型, id)排成一个有序数组，前缀查询用二分查找定位到第一个
+    不小于前缀的位置，再顺序取出以该前缀开头的条目，耗时只和结果数有关。
+    相比字典树更省内存，插入和删除是一次二分查找加一次数组移动。
+    """
+
+    def __init__(self, config_prefix, app=None):
+        self.config_prefix = config_prefix
+        self.limit = 10
+        self.loaded = False
+        self._entries = []  # (key, kind, id, name)
+        self._names = {}  # (kind, id) -> name
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limit = app.config.get(self.config_prefix + '_LIMIT', self.limit)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry(kind, id, name):
+        return name.lower(), kind, id, name
+
+    def load(self, items):
+        """用(类型, id, 名称)重建索引"""
+        names = {(kind, id): name for kind, id, name in items if name}
+        entries = sorted(self._entry(kind, id, name) for (kind, id), name in names.items())
+        with self._lock:
+            self._entries = entries
+            self._names = names
+            self.loaded = True
+
+    def insert(self, kind, id, name):
+        """加入或更新(改名)一个条目"""
+        with self._lock:
+            self._remove(kind, id)
+            if name:
+                insort(self._entries, self._entry(kind, id, name))
+                self._names[kind, id] = name
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(kind, id)
+
+    def _remove(self, kind, id):
+        name = self._names.pop((kind, id), None)
+        if name is None:
+            return
+        entry = self._entry(kind, id, name)
+        position = bisect_left(self._entries, entry)
+        if position < len(self._entries) and self._entries[position] == entry:
+            del self._entries[position]
+
+    def search(self, prefix, limit=None):
+        """返回以prefix开头(不区分大小写)的条目[(类型, id, 名称)]"""
+        prefix = prefix.lower()
+        limit = limit or self.limit
+        entries = self._entries  # load会整体替换数组，这里拿到的是一致的快照
+        results = []
+        position = bisect_left(entries, (prefix,))
+        while position < len(entries) and len(results) < limit:
+            key, kind, id, name = entries[position]
+            if not key.startswith(prefix):
+                break
+            results.append((kind, id, name))
+            position += 1
+        return results
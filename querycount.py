@@ -0,0 +1,60 @@
+from functools import wraps
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """视图执行的SQL语句数超出预算"""
+
+
+def query_budget(limit):
+    """为单个视图指定SQL语句数预算，覆盖YGQ_QUERY_BUDGET"""
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            g.query_budget = limit
+            return func(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+class QueryCounter(object):
+    """统计每个请求执行的SQL语句数，用于发现N+1查询
+
+    YGQ_QUERY_BUDGET为None时不启用；超出预算时记录警告，
+    YGQ_QUERY_BUDGET_RAISE为True时(测试环境)直接抛出异常让测试失败。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('YGQ_QUERY_BUDGET') is None:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', _count_query):
+            event.listen(Engine, 'before_cursor_execute', _count_query)
+
+        @app.before_request
+        def reset_query_count():
+            g.query_count = 0
+            g.pop('query_budget', None)
+
+        @app.after_request
+        def check_query_budget(response):
+            count = g.get('query_count', 0)
+            budget = g.get('query_budget', app.config['YGQ_QUERY_BUDGET'])
+            response.headers['X-Query-Count'] = str(count)
+            if count > budget:
+                message = '%s executed %d SQL statements, budget is %d.' % (request.endpoint, count, budget)
+                if app.config['YGQ_QUERY_BUDGET_RAISE']:
+                    raise QueryBudgetExceeded(message)
+                app.logger.warning(message)
+            return response
@@ -0,0 +1,80 @@
+import math
+import random
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from .extensions import db
+from .models import Dish
+
+
+class RandomSampler(object):
+    """按主键随机抽样
+
+    缓存主键的最小、最大值(每隔<prefix>_TTL秒刷新一次，走主键索引)，在这个区间里随机生成id，
+    用IN查询取回存在的行，开销只和抽样数有关，与表的大小无关。
+    被删除的行会造成空洞，按最近的命中率多生成一些id，几轮之后仍不够时，
+    从随机位置沿主键顺序补齐。
+    """
+    max_rounds = 3
+    max_probes = 500  # 单次IN查询的参数个数上限，SQLite默认最多999个
+
+    def __init__(self, column, config_prefix, criteria=()):
+        self.column = column
+        self.config_prefix = config_prefix
+        self.criteria = criteria  # 抽样结果还要满足的条件
+        self.hit_rate = 1.0
+        self._range = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def id_range(self):
+        ttl = current_app.config[self.config_prefix + '_TTL']
+        with self._lock:
+            if self._loaded_at is None or time.time() - self._loaded_at > ttl:
+                self._range = db.session.query(func.min(self.column), func.max(self.column)).one()
+                self._loaded_at = time.time()
+            return self._range
+
+    def expire(self):
+        self._loaded_at = None
+
+    def sample(self, k, *options):
+        low, high = self.id_range()
+        if low is None:
+            return []
+        query = self.column.class_.query.filter(*self.criteria).options(*options)
+        population = high - low + 1
+        if population <= k * 2:  # 数据很少时直接随机排序
+            return query.order_by(func.random()).limit(k).all()
+
+        found = {}
+        for _ in range(self.max_rounds):
+            need = k - len(found)
+            size = min(population, self.max_probes, int(math.ceil(need * 1.5 / self.hit_rate)))
+            probes = set(random.sample(range(low, high + 1), size)) - set(found)
+            if not probes:
+                continue
+            rows = query.filter(self.column.in_(probes)).all()
+            self.hit_rate = max(0.01, 0.5 * self.hit_rate + 0.5 * len(rows) / len(probes))
+            for row in rows:
+                found[getattr(row, self.column.key)] = row
+            if len(found) >= k:
+                break
+        else:
+            start = random.randint(low, high)
+            rest = query.filter(self.column >= start)
+            if found:
+                rest = rest.filter(~self.column.in_(found))
+            rows = rest.order_by(self.column).limit(k - len(found)).all()
+            for row in rows:
+                found[getattr(row, self.column.key)] = row
+
+        result = list(found.values())
+        random.shuffle(result)
+        return result[:k]
+
+
+dish_sampler = RandomSampler(Dish.id, 'YGQ_EXPLORE_RANGE', (Dish.visible(),))
@@ -0,0 +1,169 @@
+import random
+import time
+
+from flask_sqlalchemy import Pagination
+from sqlalchemy import event, text, or_
+
+from .extensions import db
+from .loading import dish_card
+from .models import User, Dish, Tag
+
+
+class WhoosheeBackend(object):
+    """Whoosh全文索引(flask-whooshee)"""
+    name = 'whooshee'
+
+    def search(self, query, model, q, page, per_page):
+        return query.whooshee_search(q).paginate(page, per_page)
+
+    def build(self, app):
+        from .indexing import rebuild_indexes
+        rebuild_indexes(app, processes=1)
+
+
+class FTS5Backend(object):
+    """SQLite FTS5全文索引
+
+    每个模型一张外部内容(external content)的FTS5虚拟表，只保存索引不保存原文，
+    由基表上的触发器同步，和业务数据在同一个事务里提交，多进程共享同一个数据库文件。
+    结果按bm25排序，名称列的权重更高。
+    默认使用trigram分词，支持中文和子串匹配(与whooshee的match_substrings一致)，
+    但关键字至少要三个字符，更短的关键字退回到LIKE查询。
+    """
+    name = 'fts5'
+    # 模型 -> 被索引的列及其bm25权重
+    fields = {
+        Dish: (('name', 10.0), ('description', 1.0)),
+        User: (('username', 10.0), ('name', 5.0)),
+        Tag: (('name', 1.0),),
+    }
+
+    def __init__(self, tokenizer='trigram'):
+        self.tokenizer = tokenizer
+
+    @staticmethod
+    def fts_table(model):
+        return '%s_fts' % model.__tablename__
+
+    def create(self, connection):
+        for model, fields in self.fields.items():
+            table, fts = model.__tablename__, self.fts_table(model)
+            columns = ', '.join(name for name, weight in fields)
+            new = ', '.join('new.%s' % name for name, weight in fields)
+            old = ', '.join('old.%s' % name for name, weight in fields)
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id', "
+                "tokenize='%s')" % (fts, columns, table, self.tokenizer)))
+            for statement in (
+                    'CREATE TRIGGER IF NOT EXISTS %(fts)s_ai AFTER INSERT ON "%(table)s" BEGIN '
+                    'INSERT INTO %(fts)s(rowid, %(columns)s) VALUES (new.id, %(new)s); END',
+                    'CREATE TRIGGER IF NOT EXISTS %(fts)s_ad AFTER DELETE ON "%(table)s" BEGIN '
+                    "INSERT INTO %(fts)s(%(fts)s, rowid, %(columns)s) VALUES ('delete', old.id, %(old)s); END",
+                    'CREATE TRIGGER IF NOT EXISTS %(fts)s_au AFTER UPDATE OF %(columns)s ON "%(table)s" BEGIN '
+                    "INSERT INTO %(fts)s(%(fts)s, rowid, %(columns)s) VALUES ('delete', old.id, %(old)s); "
+                    'INSERT INTO %(fts)s(rowid, %(columns)s) VALUES (new.id, %(new)s); END'):
+                connection.execute(text(statement % dict(fts=fts, table=table, columns=columns, new=new, old=old)))
+
+    def drop(self, connection):
+        for model in self.fields:
+            fts = self.fts_table(model)
+            for suffix in ('ai', 'ad', 'au'):
+                connection.execute(text('DROP TRIGGER IF EXISTS %s_%s' % (fts, suffix)))
+            connection.execute(text('DROP TABLE IF EXISTS %s' % fts))
+
+    def build(self, app):
+        """创建虚拟表和触发器(已有则跳过)，并从基表重建索引"""
+        with db.engine.begin() as connection:
+            self.create(connection)
+            for model in self.fields:
+                fts = self.fts_table(model)
+                connection.execute(text("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts)))
+
+    @staticmethod
+    def match_expression(q):
+        # 每个词用双引号括起来作为字符串，避免用户输入被当作FTS5查询语法；词之间为OR，与whooshee一致
+        return ' OR '.join('"%s"' % term.replace('"', '""') for term in q.split())
+
+    def search(self, query, model, q, page, per_page):
+        fields = self.fields[model]
+        if self.tokenizer == 'trigram' and any(len(term) < 3 for term in q.split()):
+            query = query.filter(or_(*[getattr(model, name).contains(term)
+                                     for term in q.split() for name, weight in fields]))
+            return query.order_by(model.id.desc()).paginate(page, per_page)
+
+        fts = self.fts_table(model)
+        params = dict(q=self.match_expression(q), limit=per_page, offset=(page - 1) * per_page)
+        total = db.session.execute(text('SELECT count(*) FROM %s WHERE %s MATCH :q' % (fts, fts)), params).scalar()
+        weights = ', '.join(str(weight) for name, weight in fields)
+        ids = [row[0] for row in db.session.execute(text(
+            'SELECT rowid FROM %s WHERE %s MATCH :q ORDER BY bm25(%s, %s) LIMIT :limit OFFSET :offset'
+            % (fts, fts, fts, weights)), params)]
+        rows = {item.id: item for item in query.filter(model.id.in_(ids))} if ids else {}
+        items = [rows[pk] for pk in ids if pk in rows]
+        return Pagination(None, page, per_page, total, items)
+
+
+class Search(object):
+    """按YGQ_SEARCH_BACKEND选择搜索后端"""
+    categories = {'dish': (Dish, dish_card), 'user': (User, ()), 'tag': (Tag, ())}
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['YGQ_SEARCH_BACKEND'] == 'fts5':
+            self.backend = FTS5Backend(app.config['YGQ_FTS5_TOKENIZER'])
+            # initdb、forge创建和删除表时同时处理虚拟表和触发器
+            if not event.contains(db.metadata, 'after_create', self._after_create):
+                event.listen(db.metadata, 'after_create', self._after_create)
+                event.listen(db.metadata, 'before_drop', self._before_drop)
+        else:
+            self.backend = WhoosheeBackend()
+        app.extensions['ygq_search'] = self
+
+    def _after_create(self, target, connection, **kw):
+        if isinstance(self.backend, FTS5Backend):
+            self.backend.create(connection)
+
+    def _before_drop(self, target, connection, **kw):
+        if isinstance(self.backend, FTS5Backend):
+            self.backend.drop(connection)
+
+    def paginate(self, category, q, page, per_page):
+        model, options = self.categories.get(category, self.categories['dish'])
+        query = model.query.options(*options)
+        if model is Dish:
+            query = query.filter(Dish.visible())
+        return self.backend.search(query, model, q, page, per_page)
+
+
+def sample_terms(count, length=3):
+    """从菜品名、用户名和标签中截取关键字，用于基准测试"""
+    terms = []
+    for model, name in ((Dish, 'name'), (User, 'username'), (Tag, 'name')):
+        values = [value for (value,) in db.session.query(getattr(model, name)).order_by(db.func.random()).limit(count)]
+        for value in values:
+            start = random.randint(0, max(0, len(value) - length))
+            terms.append(value[start:start + length])
+    random.shuffle(terms)
+    return terms[:count]
+
+
+def benchmark(app, backend, terms, per_page=20):
+    """返回(建索引秒数, {分类: 每次查询的毫秒数列表})"""
+    start = time.perf_counter()
+    backend.build(app)
+    build_time = time.perf_counter() - start
+    latencies = {}
+    for category, (model, options) in Search.categories.items():
+        for term in terms:
+            start = time.perf_counter()
+            backend.search(model.query.options(*options), model, term, 1, per_page).items
+            latencies.setdefault(category, []).append((time.perf_counter() - start) * 1000)
+            db.session.remove()
+    return build_time, latencies
+
+
+search = Search()
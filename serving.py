@@ -0,0 +1,112 @@
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_file, safe_join, abort
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from werkzeug.urls import url_quote
+
+# storage按内容保存的文件及其缩略图，文件名就是内容的SHA-256
+CONTENT_ADDRESSED = re.compile(r'^[0-9a-f]{64}(_[a-z]+)?\.\w+$')
+
+
+class FileServer(object):
+    """静态文件、上传文件和头像的发送
+
+    生成链接时给文件加上指纹：按内容保存的文件名本身就是摘要，其他文件在链接后加上
+    ?v=<修改时间-大小>。带指纹的链接内容不会变，响应使用一年的immutable缓存，
+    浏览器和CDN不再回源验证；不带指纹的请求使用SEND_FILE_MAX_AGE_DEFAULT并依靠ETag重新验证。
+    应用自己发送时支持If-None-Match/If-Modified-Since(304)和Range(206)，视频可以拖动。
+    YGQ_SEND_FILE设置为x-accel-redirect或x-sendfile时只返回响应头，由前端的nginx/Apache发送文件，
+    gunicorn的worker不再被大文件和慢速客户端占用；不在YGQ_SEND_FILE_ROOT下的文件仍由应用发送。
+    """
+
+    def __init__(self, app=None):
+        self.mode = None
+        self.folders = {}  # 端点 -> 目录，用于生成带指纹的链接
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config['YGQ_SEND_FILE']
+        self.folders = {
+            'main.get_image': app.config['YGQ_UPLOAD_PATH'],
+            'main.get_avatar': app.config['AVATARS_SAVE_PATH'],
+        }
+        # 应用和扩展(bootstrap等)的静态文件也由这里发送
+        statics = [('static', app)] + [('%s.static' % name, blueprint) for name, blueprint in app.blueprints.items()]
+        for endpoint, owner in statics:
+            if owner.has_static_folder and endpoint in app.view_functions:
+                self.folders[endpoint] = owner.static_folder
+                app.view_functions[endpoint] = self._static_view(owner.static_folder)
+        app.url_defaults(self.add_fingerprint)
+        app.extensions['ygq_file_server'] = self
+
+    def _static_view(self, folder):
+        def static(filename):
+            return self.send(folder, filename)
+        return static
+
+    @staticmethod
+    def fingerprint(folder, filename):
+        """按内容保存的文件返回None(文件名就是指纹)，其他文件返回修改时间和大小"""
+        if CONTENT_ADDRESSED.match(os.path.basename(filename)):
+            return None
+        try:
+            stat = os.stat(safe_join(folder, filename))
+        except (OSError, NotFound):
+            return None
+        return '%x-%x' % (int(stat.st_mtime), stat.st_size)
+
+    def add_fingerprint(self, endpoint, values):
+        folder = self.folders.get(endpoint)
+        if folder is not None and values.get('filename') and 'v' not in values:
+            fingerprint = self.fingerprint(folder, values['filename'])
+            if fingerprint is not None:
+                values['v'] = fingerprint
+
+    def send(self, folder, filename):
+        path = safe_join(folder, filename)
+        if not os.path.isfile(path):
+            abort(404)
+        fingerprint = self.fingerprint(folder, filename)
+        if fingerprint is None:
+            immutable, etag = True, os.path.basename(filename)
+        else:
+            immutable, etag = request.args.get('v') == fingerprint, fingerprint
+        if immutable:
+            max_age = current_app.config['YGQ_IMMUTABLE_MAX_AGE']
+            cache_control = 'public, max-age=%d, immutable' % max_age
+        else:
+            max_age = current_app.get_send_file_max_age(filename)
+            cache_control = 'public, max-age=%d' % max_age
+
+        if self.mode and self._under_root(path):
+            rv = self._offload(path, filename)
+        else:
+            rv = send_file(path, add_etags=False, cache_timeout=max_age)
+            rv.set_etag(etag)
+            try:
+                rv = rv.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+            except RequestedRangeNotSatisfiable:
+                rv.close()
+                raise
+        rv.headers['Cache-Control'] = cache_control
+        return rv
+
+    @staticmethod
+    def _under_root(path):
+        """前端服务器只能发送YGQ_SEND_FILE_ROOT下的文件，扩展在site-packages里的静态文件仍由应用发送"""
+        root = os.path.realpath(current_app.config['YGQ_SEND_FILE_ROOT'])
+        return os.path.realpath(path).startswith(os.path.join(root, ''))
+
+    def _offload(self, path, filename):
+        """只返回响应头，条件请求和Range都由前端服务器处理"""
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        rv = current_app.response_class(mimetype=mimetype)
+        if self.mode == 'x-accel-redirect':
+            relative = os.path.relpath(path, current_app.config['YGQ_SEND_FILE_ROOT']).replace(os.sep, '/')
+            rv.headers['X-Accel-Redirect'] = url_quote(current_app.config['YGQ_X_ACCEL_PREFIX'] + relative)
+        else:
+            rv.headers['X-Sendfile'] = path
+        return rv
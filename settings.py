@@ -41,6 +41,9 @@ class BaseConfig:
     YGQ_MANAGE_TAG_PER_PAGE = 50
     YGQ_MANAGE_COMMENT_PER_PAGE = 30
     YGQ_SEARCH_RESULT_PER_PAGE = 20
+    YGQ_PAGINATION_MODE = 'keyset'  # keyset: 游标分页，只有上一页/下一页; offset: 页码分页
+    YGQ_EXPLORE_PER_PAGE = 12
+    YGQ_EXPLORE_RANGE_TTL = 60  # 随机抽样缓存的主键范围的刷新间隔(秒)
 
     # 图片上传
     YGQ_UPLOAD_PATH = os.path.join(basedir, 'uploads')
@@ -49,12 +52,30 @@ class BaseConfig:
         YGQ_DISH_SIZE['small']: '_s',
         YGQ_DISH_SIZE['medium']: '_m',
     }
+    YGQ_THUMBNAIL_TICK = 1  # 生成缩略图的间隔(秒)
+    YGQ_THUMBNAIL_RESCAN = 300  # 扫描遗漏的缩略图的间隔(秒)
+    YGQ_THUMBNAIL_BATCH_SIZE = 100  # 每个事务处理的文件数
     MAX_CONTENT_LENGTH = 30 * 1024 * 1024  # 上传最大值
 
+    # 文件发送
+    YGQ_SEND_FILE = os.getenv('YGQ_SEND_FILE')  # None: 由应用发送; x-accel-redirect: nginx发送; x-sendfile: Apache/lighttpd发送
+    YGQ_SEND_FILE_ROOT = basedir  # 只有这个目录下的文件交给前端服务器发送，X-Accel-Redirect中的路径相对于它
+    YGQ_X_ACCEL_PREFIX = '/_files/'  # nginx中指向YGQ_SEND_FILE_ROOT的internal location
+    YGQ_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # 带指纹的文件的缓存时间
+
     DROPZONE_ALLOWED_FILE_TYPE = 'default'  # 设置允许的文件类型
     DROPZONE_MAX_FILE_SIZE = 30
     DROPZONE_MAX_FILES = 30
     DROPZONE_ENABLE_CSRF = True
+    YGQ_UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024  # 分块上传的块大小，每个请求只处理一块
+    YGQ_UPLOAD_CHUNK_RETRIES = 3  # 分块上传失败时的重传次数
+    YGQ_UPLOAD_STAGING_TTL = 24 * 3600  # 上传后多少秒仍未发布到菜品的文件会被清理
+    YGQ_UPLOAD_SWEEP_TICK = 3600  # 清理未认领上传的间隔(秒)
+    YGQ_FILE_REAPER_TICK = 60  # 删除文件的间隔(秒)，有删除提交时会立即唤醒
+    YGQ_FILE_REAPER_ATTEMPTS = 5  # 删除失败的重试次数
+    YGQ_DELETION_TICK = 10  # 检查未完成的删除任务的间隔(秒)
+    YGQ_DELETION_BATCH_SIZE = 200  # 删除用户、店铺时每个事务删除的记录数
+    YGQ_DELETION_PAUSE = 0.05  # 两批之间暂停的秒数，让其他请求拿到写锁
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
 
@@ -67,6 +88,43 @@ class BaseConfig:
     AVATARS_SIZE_TUPLE = (30, 100, 200)  # 小、中、大头像图片大小元组
 
     WHOOSHEE_MIN_STRING_LEN = 1  # 搜索关键字的最小字符数
+    WHOOSHEE_ENABLE_INDEXING = False  # 不在请求中同步写索引，由后台任务批量更新
+    YGQ_SEARCH_INDEX_TICK = 2  # 批量写入索引的间隔(秒)，即索引最多落后的时间
+    YGQ_SEARCH_INDEX_WRITER_TIMEOUT = 10  # 后台任务等待索引写锁的秒数
+    YGQ_SEARCH_BACKEND = os.getenv('YGQ_SEARCH_BACKEND', 'whooshee')  # whooshee; fts5: SQLite全文索引，只能用于SQLite
+    YGQ_FTS5_TOKENIZER = 'trigram'  # FTS5分词器，trigram支持中文和子串匹配(需要SQLite 3.34+)
+    YGQ_AUTOCOMPLETE_LIMIT = 10  # 自动补全返回的条目数
+    YGQ_AUTOCOMPLETE_REFRESH = 300  # 从数据库重建前缀索引的间隔(秒)
+    YGQ_TAG_CACHE_SIZE = 10000  # 进程内缓存的标签名数量上限
+    YGQ_TAG_CACHE_TIMEOUT = 3600
+
+    # 附近菜品
+    YGQ_SHOP_INDEX_CELL = 100  # 店铺空间索引的网格边长，也是附近菜品结果共享缓存的范围
+    YGQ_SHOP_INDEX_TTL = 300
+    YGQ_NEARBY_RADIUS = 300  # 附近菜品的搜索半径(曼哈顿距离)
+    YGQ_NEARBY_CACHE_SIZE = 1000  # 缓存的网格数上限
+    YGQ_NEARBY_CACHE_TIMEOUT = 60
+
+    # 骑手调度
+    YGQ_RIDER_INDEX_CELL = 50  # 骑手空间索引的网格边长
+    YGQ_RIDER_INDEX_TTL = 30  # 空间索引与数据库重新同步的间隔(秒)，兼顾多进程部署
+    YGQ_DISPATCH_CANDIDATES = 5  # 每单从索引中取出的候选骑手数
+    YGQ_DISPATCH_MODE = os.getenv('YGQ_DISPATCH_MODE', 'immediate')  # immediate: 下单即派单; batch: 批量派单
+    YGQ_DISPATCH_WINDOW = 1.5  # 批量派单的时间窗口(秒)
+    YGQ_DISPATCH_RESCAN = 60  # 从数据库重新载入未派单订单的间隔(秒)
+    YGQ_DELIVERY_TICK = 1  # 检查到期订单的间隔(秒)
+    YGQ_DELIVERY_RESCAN = 300  # 从数据库重新载入未完成订单的间隔(秒)
+
+    YGQ_BACKGROUND_TASKS = True  # 是否在每个进程里启动后台任务线程
+
+    YGQ_QUERY_BUDGET = None  # 每个请求允许执行的SQL语句数，None表示不检查
+    YGQ_QUERY_BUDGET_RAISE = False  # 超出预算时抛出异常而不是记录警告
+
+    # lru: 进程内缓存，失效只通知提交所在的进程，只能用于单进程部署; redis: 多进程共享; None: 不缓存
+    YGQ_PAGE_CACHE = os.getenv('YGQ_PAGE_CACHE', 'redis' if os.getenv('REDIS_URL') else 'lru')
+    YGQ_PAGE_CACHE_SIZE = 1000  # lru缓存的页面数上限
+    YGQ_PAGE_CACHE_TIMEOUT = 300  # 缓存的页面最多保留的秒数
+    YGQ_PAGE_CACHE_REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
     # 定时器配置项
     # 持久化配置，数据持久化至MongoDB
@@ -86,17 +144,26 @@ class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = \
         prefix + os.path.join(basedir, 'data-dev.db')
     REDIS_URL = "redis://localhost"
+    YGQ_QUERY_BUDGET = 20
 
 
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    YGQ_BACKGROUND_TASKS = False
+    WHOOSHEE_ENABLE_INDEXING = True  # 没有后台任务，同步写索引
+    WHOOSHEE_MEMORY_STORAGE = True  # 与内存数据库一起，测试之间不留下索引文件
+    YGQ_QUERY_BUDGET = 20
+    YGQ_QUERY_BUDGET_RAISE = True
+    YGQ_PAGE_CACHE = None
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
 
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL',
                                         prefix + os.path.join(basedir, 'data.db'))
+    # gunicorn多个worker时进程内缓存会在其他worker里保留过期页面，没有配置Redis时不缓存
+    YGQ_PAGE_CACHE = os.getenv('YGQ_PAGE_CACHE', 'redis' if os.getenv('REDIS_URL') else None)
 
 
 config = {
@@ -225,6 +225,32 @@ $(function () {
         setInterval(update_notifications_count, 30000);
     }
 
+    // search autocomplete
+    var autocomplete_timer = null;
+    $('input[list=autocomplete-list]').on('input', function () {
+        var $input = $(this);
+        var q = $.trim($input.val());
+        clearTimeout(autocomplete_timer);
+        if (!q) {
+            $('#autocomplete-list').empty();
+            return;
+        }
+        autocomplete_timer = setTimeout(function () {
+            $.ajax({
+                type: 'GET',
+                url: $input.data('href'),
+                data: {q: q},
+                global: false,
+                success: function (data) {
+                    var $list = $('#autocomplete-list').empty();
+                    $.each(data.results, function (i, item) {
+                        $list.append($('<option>').attr('value', item.name).text(item.type));
+                    });
+                }
+            });
+        }, 100);
+    });
+
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')})
 
 });
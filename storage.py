@@ -0,0 +1,246 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from .extensions import db
+from .models import Blob, File, DeletedFile
+from .tasks import PeriodicWorker
+from .utils import is_image
+
+CHUNK_SIZE = 64 * 1024
+UPLOAD_ID = re.compile(r'^[0-9a-f-]{1,64}$')
+
+
+def save_blob(stream, filename):
+    """保存上传的内容，返回对应的Blob
+
+    边读边计算SHA-256并写入上传目录下的临时文件，内容已经存在时丢弃临时文件，
+    否则改名为"摘要+扩展名"。文件名由内容决定，同一内容只保存一份。
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temp = tempfile.mkstemp(dir=current_app.config['YGQ_UPLOAD_PATH'], prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temp)
+        raise
+    return store_blob(temp, sha256.hexdigest(), size, filename)
+
+
+def store_blob(temp, digest, size, filename):
+    """把上传目录下已经写完的临时文件登记为Blob，临时文件被改名或删除"""
+    upload_path = current_app.config['YGQ_UPLOAD_PATH']
+    try:
+        blob = Blob.query.filter_by(digest=digest).first()
+        if blob is None:
+            blob = Blob(digest=digest, filename=digest + os.path.splitext(filename)[1].lower(), size=size)
+            # 冲突时只回滚这条插入，调用方事务里的其他改动不受影响；
+            # 回滚保存点也会触发after_rollback，事务的session.info记录(索引、页面缓存、删除日志等)需要恢复
+            savepoint = db.session.begin_nested()
+            info = dict(db.session.info)
+            db.session.add(blob)
+            try:
+                savepoint.commit()
+            except IntegrityError:  # 其他请求同时上传了相同的内容
+                savepoint.rollback()
+                db.session.info.update(info)
+                blob = Blob.query.filter_by(digest=digest).one()
+        path = os.path.join(upload_path, blob.filename)
+        if not os.path.exists(path):
+            os.replace(temp, path)
+            temp = None
+    finally:
+        if temp is not None:
+            os.remove(temp)
+    return blob
+
+
+def chunk_path(upload_id):
+    """分块上传的临时文件，upload_id是Dropzone为每个文件生成的uuid"""
+    if not UPLOAD_ID.match(upload_id):
+        raise ValueError('Invalid upload id.')
+    return os.path.join(current_app.config['YGQ_UPLOAD_PATH'], '.chunk-%s' % upload_id)
+
+
+def chunk_offset(upload_id):
+    """已经收到的字节数，断线后客户端从这里继续上传"""
+    try:
+        return os.path.getsize(chunk_path(upload_id))
+    except OSError:
+        return 0
+
+
+def write_chunk(upload_id, stream, offset):
+    """把一个分块写到临时文件的offset处，返回临时文件的大小
+
+    按偏移写入，重传的分块会覆盖原来的内容，重试是幂等的。
+    偏移为负或超出MAX_CONTENT_LENGTH时抛出ValueError，整个文件不会超过单次上传的上限。
+    """
+    limit = current_app.config['MAX_CONTENT_LENGTH']
+    if offset < 0 or (limit is not None and offset > limit):
+        raise ValueError('Invalid chunk offset.')
+    path = chunk_path(upload_id)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'wb') as f:
+        f.seek(offset)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            if limit is not None and f.tell() + len(chunk) > limit:
+                f.close()
+                os.remove(path)
+                raise ValueError('Upload too large.')
+            f.write(chunk)
+        f.seek(0, os.SEEK_END)
+        return f.tell()
+
+
+def finish_chunks(upload_id, filename, total_size, **kwargs):
+    """所有分块都收到后计算摘要并保存，返回加入会话的File；大小不符时丢弃临时文件并返回None"""
+    temp = chunk_path(upload_id)
+    sha256 = hashlib.sha256()
+    try:
+        if os.path.getsize(temp) != total_size:
+            os.remove(temp)
+            return None
+        with open(temp, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+    except OSError:  # 重传的最后一个分块和先到的同时完成，临时文件已经被处理
+        return None
+    return _add_file(store_blob(temp, sha256.hexdigest(), total_size, filename), **kwargs)
+
+
+def save_file(stream, filename, **kwargs):
+    """保存上传的文件，返回加入会话的File
+
+    内容已经存在时只增加一条File记录，并沿用已经生成的缩略图。
+    """
+    return _add_file(save_blob(stream, filename), **kwargs)
+
+
+def _add_file(blob, **kwargs):
+    file = File(filename=blob.filename, blob=blob, **kwargs)
+    file.is_img = is_image(os.path.join(current_app.config['YGQ_UPLOAD_PATH'], blob.filename))
+    sibling = File.query.filter(File.blob_id == blob.id, File.filename_s != None).first()
+    if sibling is not None:
+        file.filename_s, file.filename_m = sibling.filename_s, sibling.filename_m
+    db.session.add(file)
+    return file
+
+
+class UploadSweeper(PeriodicWorker):
+    """后台清理没有被认领的上传
+
+    上传后超过YGQ_UPLOAD_STAGING_TTL秒仍未发布到菜品的File按批删除，Blob的引用计数和磁盘文件
+    由File的删除事件处理；同时删除中断的分块上传留下的临时文件。
+    """
+    name = 'ygq_upload_sweeper'
+    interval_key = 'YGQ_UPLOAD_SWEEP_TICK'
+
+    def tick(self):
+        self.sweep()
+
+    def sweep(self, batch_size=500):
+        """返回删除的File数和临时文件数"""
+        ttl = self.app.config['YGQ_UPLOAD_STAGING_TTL']
+        cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+        count = 0
+        while True:
+            # 加上时间戳之前留下的未认领文件时间戳为空，也都已经过期
+            files = File.query.filter(File.is_use == False, db.or_(File.timestamp < cutoff, File.timestamp == None)) \
+                .limit(batch_size).all()
+            for file in files:
+                db.session.delete(file)
+            db.session.commit()
+            count += len(files)
+            if len(files) < batch_size:
+                break
+
+        temps = 0
+        upload_path = self.app.config['YGQ_UPLOAD_PATH']
+        for entry in os.scandir(upload_path):
+            if entry.name.startswith(('.chunk-', '.upload-')) and entry.stat().st_mtime < time.time() - ttl:
+                try:
+                    os.remove(entry.path)
+                    temps += 1
+                except OSError:
+                    pass
+        return count, temps
+
+
+upload_sweeper = UploadSweeper()
+
+
+class FileReaper(PeriodicWorker):
+    """后台删除磁盘上的文件
+
+    删除用户、菜品和上传文件时，after_delete事件只在同一个事务里写一条DeletedFile日志，请求不再逐个
+    删除文件；事务回滚时日志一起回滚，文件不会被误删。提交后唤醒后台线程按批删除文件，
+    失败的(例如权限问题)保留日志，在之后的周期里重试，最多YGQ_FILE_REAPER_ATTEMPTS次。
+    每一批先更新日志加锁再删除文件，同名文件被重新使用时撤销日志的事务会等这一批提交，
+    不会出现新文件刚写入就被删除的情况。
+    """
+    name = 'ygq_file_reaper'
+    interval_key = 'YGQ_FILE_REAPER_TICK'
+
+    def init_app(self, app):
+        super(FileReaper, self).init_app(app)
+        for name, listener in (('after_commit', self.wake_on_commit),
+                               ('after_rollback', self.discard)):
+            if not event.contains(db.session, name, listener):
+                event.listen(db.session, name, listener)
+
+    def wake_on_commit(self, session):
+        if session.info.pop('deleted_files', None):
+            self.wake()
+
+    def discard(self, session):
+        session.info.pop('deleted_files', None)
+
+    def tick(self):
+        self.reap()
+
+    def reap(self, batch_size=500):
+        """返回删除的文件数"""
+        max_attempts = self.app.config['YGQ_FILE_REAPER_ATTEMPTS']
+        count = 0
+        last_id = 0
+        while True:
+            ids = [id for (id,) in db.session.query(DeletedFile.id).filter(
+                DeletedFile.id > last_id, DeletedFile.attempts < max_attempts).order_by(DeletedFile.id).limit(batch_size)]
+            if not ids:
+                break
+            last_id = ids[-1]
+            DeletedFile.query.filter(DeletedFile.id.in_(ids)).update(
+                {DeletedFile.attempts: DeletedFile.attempts + 1}, synchronize_session=False)
+            rows = db.session.query(DeletedFile.id, DeletedFile.folder, DeletedFile.filename) \
+                .filter(DeletedFile.id.in_(ids)).all()  # 加锁之后仍在日志里的
+            done = []
+            for id, folder, filename in rows:
+                try:
+                    os.remove(os.path.join(self.app.config[folder], filename))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    self.app.logger.exception('Failed to delete %s.', filename)
+                    continue
+                done.append(id)
+            if done:
+                DeletedFile.query.filter(DeletedFile.id.in_(done)).delete(synchronize_session=False)
+            db.session.commit()
+            count += len(done)
+        return count
+
+
+file_reaper = FileReaper()
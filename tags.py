@@ -0,0 +1,127 @@
+from flask import current_app
+from sqlalchemy import exists
+
+from .cache import LRUBackend
+from .extensions import db, autocomplete_index
+from .indexing import indexer
+from .models import Tag, tagging
+
+
+def split_tags(text):
+    """按空白分隔的标签名，去掉重复并保持顺序"""
+    names = []
+    for name in text.split():
+        if name not in names:
+            names.append(name)
+    return names
+
+
+class TagResolver(object):
+    """标签名到id的批量解析
+
+    发布菜品和添加标签时，先在进程内的LRU缓存里查标签名，缓存未命中的用一条IN查询取出，
+    仍不存在的用一条忽略冲突的INSERT(SQLite的OR IGNORE、PostgreSQL的ON CONFLICT DO NOTHING)
+    一次插入，并发请求插入同名标签时不会出错。关联也是一条INSERT，菜品数用一条UPDATE维护，
+    整个过程在调用方的一个事务里完成。
+    缓存的id可能已经失效(标签被其他进程删除，或SQLite在回滚、删除后重用了rowid)，关联前会确认
+    id仍然属于同名的标签，失效的条目从缓存中去掉并重新解析。解析结果在事务提交后才写入缓存。
+    """
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUBackend(current_app.config['YGQ_TAG_CACHE_SIZE'])
+        return self._cache
+
+    def resolve(self, names):
+        """返回{标签名: id}，不存在的标签会被创建(需要提交)"""
+        ids, missing = {}, []
+        for name in names:
+            tag_id = self.cache.get(name)
+            if tag_id is None:
+                missing.append(name)
+            else:
+                ids[name] = tag_id
+        if missing:
+            found = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)))
+            new = [name for name in missing if name not in found]
+            if new:
+                self._insert(new)
+                created = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(new)))
+                indexer.index_later(db.session, Tag, created.values())
+                for name, tag_id in created.items():
+                    autocomplete_index.insert('tag', tag_id, name)
+                found.update(created)
+            db.session.info.setdefault('resolved_tags', {}).update(found)
+            ids.update(found)
+        return ids
+
+    def _insert(self, names):
+        table = Tag.__table__
+        rows = [{'name': name, 'dish_count': 0} for name in names]
+        if db.engine.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table).values(rows).on_conflict_do_nothing(index_elements=['name'])
+        elif db.engine.name == 'mysql':
+            statement = table.insert().values(rows).prefix_with('IGNORE')
+        else:
+            statement = table.insert().values(rows).prefix_with('OR IGNORE')
+        db.session.execute(statement)
+
+    def forget(self, name):
+        self.cache.delete(name)
+
+    def cache_on_commit(self, session):
+        resolved = session.info.pop('resolved_tags', None)
+        if resolved:
+            timeout = current_app.config['YGQ_TAG_CACHE_TIMEOUT']
+            for name, tag_id in resolved.items():
+                self.cache.set(name, tag_id, timeout)
+
+    def discard(self, session):
+        session.info.pop('resolved_tags', None)
+
+    def link(self, dish, names, retry=True):
+        """给菜品加上标签(需要提交)，已经有的标签跳过，返回新加上的标签数"""
+        ids = self.resolve(names)
+        if not ids:
+            return 0
+        linked = exists().where(db.and_(tagging.c.dish_id == dish.id, tagging.c.tag_id == Tag.id))
+        rows = dict((id, (name, exist)) for id, name, exist in
+                    db.session.query(Tag.id, Tag.name, linked).filter(Tag.id.in_(ids.values())))
+        stale = [name for name, tag_id in ids.items() if rows.get(tag_id, (None,))[0] != name]
+        if stale and retry:
+            for name in stale:
+                self.forget(name)
+            return self.link(dish, names, retry=False)
+
+        new = [tag_id for name, tag_id in ids.items() if rows.get(tag_id) == (name, False)]
+        if new:
+            db.session.execute(tagging.insert().values([{'dish_id': dish.id, 'tag_id': tag_id} for tag_id in new]))
+            table = Tag.__table__
+            db.session.execute(table.update().where(table.c.id.in_(new)).values(dish_count=table.c.dish_count + 1))
+            db.session.info['page_cache_dirty'] = True
+            db.session.expire(dish, ['tags'])
+        return len(new)
+
+
+tag_resolver = TagResolver()
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def cache_resolved_tags(session):
+    tag_resolver.cache_on_commit(session)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_resolved_tags(session):
+    tag_resolver.discard(session)
+
+
+@db.event.listens_for(Tag, 'after_delete', named=True)
+def forget_tag(**kwargs):
+    """本进程删除的标签不再留在缓存里"""
+    tag_resolver.forget(kwargs['target'].name)
@@ -0,0 +1,68 @@
+import threading
+
+from .extensions import db
+
+
+class PeriodicWorker(object):
+    """后台周期任务
+
+    每个进程一个守护线程，每隔interval_key配置的秒数(或被wake唤醒时)执行一次tick。
+    线程在第一个请求到来时才启动，避免gunicorn预加载时把线程留在父进程里，
+    命令行命令也不会启动它。
+    """
+    name = None
+    interval_key = None
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions[self.name] = self
+        if app.config['YGQ_BACKGROUND_TASKS']:
+            app.before_first_request(self.start)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if not self.running:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """不等到下一个周期，立即执行一次"""
+        self._event.set()
+
+    def _run(self):
+        self._call(self.setup)
+        while True:
+            self._event.wait(self.app.config[self.interval_key])
+            self._event.clear()
+            self._call(self.tick)
+
+    def _call(self, func):
+        # 推送通知时要用url_for生成链接，所以需要请求上下文
+        with self.app.test_request_context():
+            try:
+                func()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Background task %s failed.', self.name)
+
+    def run_once(self):
+        self._call(self.tick)
+
+    def setup(self):
+        """线程启动后、第一次tick之前执行"""
+        pass
+
+    def tick(self):
+        raise NotImplementedError
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from ygq import create_app
+from ygq.extensions import db
+from ygq.models import User, Dish, Tag, Shop, Rider, Collect
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        from ygq.fakes import fake, fake_user, fake_shop, fake_follow, fake_tag, fake_dish, fake_collect, \
+            fake_comment, fake_order
+        random.seed(0)
+        fake.seed_instance(0)
+        db.create_all()
+        fake_user(10)
+        fake_shop(5)
+        fake_follow(30)
+        fake_tag(10)
+        fake_dish(40)
+        fake_collect(50)
+        fake_comment(100)
+        fake_order(50)
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def urls():
+    """每个列表页取一个有数据的实例"""
+    user = User.query.join(Collect, Collect.collector_id == User.id).first()
+    tag = Tag.query.order_by(Tag.dish_count.desc()).first()
+    return [
+        '/',
+        '/tag/%d' % tag.id,
+        '/tag/%d/by_collects' % tag.id,
+        '/shop/%d' % Shop.query.join(Dish).first().id,
+        '/user/%s' % user.username,
+        '/user/%s/collections' % user.username,
+        '/rider/%d' % Rider.query.first().id,
+    ]
+
+
+def test_views_within_query_budget(app, client):
+    # 超出YGQ_QUERY_BUDGET时测试配置下抛出QueryBudgetExceeded
+    for url in urls():
+        db.session.remove()
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert int(response.headers['X-Query-Count']) <= app.config['YGQ_QUERY_BUDGET'], url
+
+
+def test_views_within_query_budget_when_logged_in(app, client):
+    user = User.query.first()
+    client.post('/auth/login', data=dict(email=user.email, password='123456'))
+    for url in urls():
+        db.session.remove()
+        response = client.get(url)
+        assert response.status_code == 200, url
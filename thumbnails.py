@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+from .extensions import db
+from .models import File
+from .tasks import PeriodicWorker
+from .utils import resize_image
+
+
+class ThumbnailWorker(PeriodicWorker):
+    """后台生成菜品图片的缩略图
+
+    上传请求只保存原图，文件id放进队列后由后台线程按YGQ_DISH_SIZE生成_s、_m两种尺寸，
+    记录到File.filename_s和File.filename_m；生成之前模板使用原图。
+    启动时以及每隔YGQ_THUMBNAIL_RESCAN秒扫描还没有缩略图的文件，其他进程或重启前留下的也不会漏掉。
+    每批最多处理YGQ_THUMBNAIL_BATCH_SIZE个文件并单独提交，积压很多时不会长时间占用写锁。
+    """
+    name = 'ygq_thumbnail'
+    interval_key = 'YGQ_THUMBNAIL_TICK'
+
+    def __init__(self, app=None):
+        self._queue = deque()
+        self._queue_lock = threading.Lock()
+        self._recovered_at = None
+        super(ThumbnailWorker, self).__init__(app)
+
+    def submit(self, file):
+        if not current_app.config['YGQ_BACKGROUND_TASKS']:  # 没有后台任务时直接生成
+            self.process([file.id])
+            return
+        with self._queue_lock:
+            self._queue.append(file.id)
+        self.wake()
+
+    def recover(self):
+        """找出还没有缩略图的图片"""
+        pending = db.session.query(File.id).filter(File.is_img == True, File.filename_s == None)
+        ids = [id for (id,) in pending]
+        with self._queue_lock:
+            self._queue.extend(ids)
+        self._recovered_at = time.time()
+
+    def setup(self):
+        self.recover()
+
+    def tick(self):
+        if self._recovered_at is None or \
+                time.time() - self._recovered_at > self.app.config['YGQ_THUMBNAIL_RESCAN']:
+            self.recover()
+        with self._queue_lock:
+            ids = list(set(self._queue))
+            self._queue.clear()
+        batch_size = self.app.config['YGQ_THUMBNAIL_BATCH_SIZE']
+        for start in range(0, len(ids), batch_size):
+            try:
+                self.process(ids[start:start + batch_size])
+            except Exception:  # 没处理的放回队列，下一轮继续
+                with self._queue_lock:
+                    self._queue.extend(ids[start:])
+                raise
+
+    def process(self, ids):
+        """为ids中的图片生成缩略图，返回处理的文件数"""
+        upload_path = current_app.config['YGQ_UPLOAD_PATH']
+        sizes = current_app.config['YGQ_DISH_SIZE']
+        files = File.query.filter(File.id.in_(ids), File.is_img == True, File.filename_s == None).all()
+        for file in files:
+            path = os.path.join(upload_path, file.filename)
+            try:
+                file.filename_s = resize_image(path, file.filename, sizes['small'])
+                file.filename_m = resize_image(path, file.filename, sizes['medium'])
+            except Exception:  # 原图丢失、无法解析或过大(DecompressionBombError)时直接使用原图，不再重试
+                current_app.logger.exception('Failed to resize %s.', file.filename)
+                file.filename_s = file.filename_m = file.filename
+        db.session.commit()
+        return len(files)
+
+
+thumbnails = ThumbnailWorker()
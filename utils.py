@@ -77,7 +77,7 @@ def resize_image(image, filename, base_width):
         return filename + ext
     w_percent = (base_width / float(img.size[0]))
     h_size = int((float(img.size[1]) * float(w_percent)))
-    img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
+    img = img.resize((base_width, h_size), PIL.Image.LANCZOS)
 
     filename += current_app.config['YGQ_DISH_SUFFIX'][base_width] + ext
     img.save(os.path.join(current_app.config['YGQ_UPLOAD_PATH'], filename), optimize=True, quality=85)